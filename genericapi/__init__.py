@@ -1,4 +1,9 @@
 from core import *
 from dispatch import *
 from response import *
+from client import *
+from pagination import *
+from keys import *
+from jobs import *
+from consumer import *
 #from xmlrpc import *
\ No newline at end of file
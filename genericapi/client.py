@@ -0,0 +1,67 @@
+from core import MethodNotFoundError
+from dispatch import SimpleDispatcher
+import core
+
+__all__ = (
+    'Client',
+)
+
+class Client(object):
+    """
+    Calls API methods in-process, without going through request parsing.
+    Usually retrieved via ``GenericAPI.get_client``:
+
+    client = MyAPI.get_client()
+    client.comments.add("great post", moderation=True, request=request)
+
+    Each method path is resolved only once, and the resulting method then
+    reused, until the API is modified. Like with ``GenericAPI.execute``,
+    ``request`` has to be passed as a keyword argument, and defaults to
+    ``None``.
+    """
+    def __init__(self, api, response_class=None):
+        self._dispatcher = SimpleDispatcher(api, response_class)
+        self._methods = {}
+        self._children = {}
+
+    def __getattr__(self, name):
+        return _child(self, self, (), name)
+
+    def call(self, path, args, kwargs):
+        """
+        Calls the method at ``path`` (a list or tuple of names).
+        """
+        dispatcher = self._dispatcher
+        context = dispatcher.create_context(kwargs.pop('request', None), path)
+        path = tuple(path)
+        method, version = self._methods.get(path, (None, None))
+        if method is None or version != core._api_version:
+            method = dispatcher.api.resolve(path)
+            if method is None:
+                error = MethodNotFoundError(method=list(path))
+                return dispatcher.respond(context,
+                    dispatcher.process_error(context, error))
+            self._methods[path] = (method, core._api_version)
+        return dispatcher.dispatch_method(context, method, list(args), kwargs)
+
+class _Path(object):
+    """
+    A (partial) method path on a ``Client``; calling it calls the method.
+    """
+    def __init__(self, client, path):
+        self._client, self._path = client, path
+        self._children = {}
+    def __getattr__(self, name):
+        return _child(self, self._client, self._path, name)
+    def __call__(self, *args, **kwargs):
+        return self._client.call(self._path, args, kwargs)
+
+def _child(parent, client, path, name):
+    # don't let the protocol lookups of python itself (copy, pickle...) turn
+    # into method paths.
+    if name.startswith('__'):
+        raise AttributeError(name)
+    child = parent._children.get(name)
+    if child is None:
+        child = parent._children[name] = _Path(client, path + (name,))
+    return child
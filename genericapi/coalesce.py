@@ -0,0 +1,106 @@
+import sys, threading
+
+__all__ = (
+    'Coalescer', 'WaitTimeout', 'freeze',
+)
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple([_freeze(v) for v in value])
+    elif isinstance(value, dict):
+        return (dict, _freeze(sorted(value.items())))
+    hash(value)
+    # True, 1 and 1.0 are equal, but are different arguments
+    return (type(value), value)
+
+def freeze(value):
+    """
+    Converts ``value``, usually a structure of decoded call arguments, into
+    something hashable that can be used as a dictionary key. Lists become
+    tuples, dicts become sorted tuples of their items, and other values are
+    paired with their type. Returns ``None`` if this isn't possible because
+    of an unhashable value.
+    """
+    try:
+        return _freeze(value)
+    except TypeError:
+        return None
+
+class WaitTimeout(Exception):
+    """
+    Raised by ``Coalescer.run`` if the call being waited for didn't finish
+    in time.
+    """
+
+class _Flight(object):
+    """
+    A call currently in progress, and the callers waiting for it.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = self.exc_info = None
+
+    def get(self):
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+class Coalescer(object):
+    """
+    Makes sure that a function is only run once for all callers that
+    concurrently request the same ``key`` ("single-flight"). The first caller
+    does the actual work, everybody arriving while it is still in progress
+    simply waits and then receives the same result (or exception).
+
+    Nothing is cached: As soon as the call has finished, the next caller
+    using the key will run the function again.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def run(self, key, func, share=None, timeout=None):
+        """
+        Call ``func`` or wait for the call already in progress for ``key``.
+
+        If given, ``share`` is applied to the result before it is handed to
+        a waiting caller, e.g. to give each caller it's own copy of a mutable
+        object. The caller that ran ``func`` gets the result unchanged.
+
+        A caller that has to wait gives up after ``timeout`` seconds, if
+        given, and raises ``WaitTimeout``.
+        """
+        self.lock.acquire()
+        try:
+            flight = self.flights.get(key)
+            if flight is None:
+                leader, flight = True, _Flight()
+                self.flights[key] = flight
+            else:
+                leader = False
+                flight.waiters += 1
+        finally:
+            self.lock.release()
+
+        if not leader:
+            flight.done.wait(timeout)
+            if not flight.done.isSet():
+                raise WaitTimeout()
+            result = flight.get()
+            if share: result = share(result)
+            return result
+
+        try:
+            try:
+                flight.result = func()
+            except Exception:
+                flight.exc_info = sys.exc_info()
+        finally:
+            self.lock.acquire()
+            try:
+                del self.flights[key]
+            finally:
+                self.lock.release()
+            flight.done.set()
+        return flight.get()
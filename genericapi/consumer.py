@@ -0,0 +1,258 @@
+"""
+Executes API calls read from a queue rather than from HTTP requests, e.g.
+for background processing with the same API classes:
+
+    queue = SqliteQueue('/var/lib/myapp/calls.db')
+    queue.put({'method': 'reports.build', 'args': [2009], 'key': 'abc'})
+
+    QueueDispatcher(MyAPI, queue).run()
+"""
+
+import time, threading, itertools, traceback, Queue
+from django.utils import simplejson
+from core import Dispatcher, APIResponse, APIError, MethodNotFoundError, \
+    BadRequestError
+
+__all__ = (
+    'QueueDispatcher', 'MemoryQueue', 'SqliteQueue', 'ResultResponse',
+)
+
+class MemoryQueue(object):
+    """
+    A queue kept in memory, for tests and for producers in the same
+    process.
+
+    Queues need to implement ``put``, ``get_batch``, ``put_results`` and
+    ``get_result``. Messages are dicts with the dotted ``method`` name, and
+    optionally ``args``, ``kwargs``, the API ``key`` and a ``deadline`` (a
+    timestamp after which the call should no longer be started). ``put``
+    adds an ``id``, which is used to pick up the result. Results are passed
+    to ``put_results`` already encoded as JSON.
+    """
+    def __init__(self):
+        self.messages = Queue.Queue()
+        self.results = {}
+        self.ids = itertools.count(1)
+
+    def put(self, message):
+        """
+        Adds a message, and returns it's id.
+        """
+        message = dict(message, id=self.ids.next())
+        self.messages.put(message)
+        return message['id']
+
+    def get_batch(self, size, timeout=None):
+        """
+        Returns up to ``size`` messages, waiting at most ``timeout`` seconds
+        for the first one. Returns an empty list if there is none.
+        """
+        try:
+            batch = [self.messages.get(timeout=timeout)]
+        except Queue.Empty:
+            return []
+        while len(batch) < size:
+            try:
+                batch.append(self.messages.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def put_results(self, results):
+        """
+        Stores the results of a batch, a list of (id, JSON text) tuples.
+        """
+        self.results.update(results)
+
+    def get_result(self, id):
+        """
+        Returns the result of a message, or ``None`` if it is not done yet.
+        """
+        body = self.results.get(id)
+        return body is not None and simplejson.loads(body) or None
+
+class SqliteQueue(object):
+    """
+    A queue stored in a SQLite database, which can be shared by several
+    processes on the same machine. Messages and results are stored as JSON.
+    A batch is taken, and it's results written, in one transaction each.
+
+    Messages are marked with the time they were taken. If their results
+    haven't been written ``retry_after`` seconds later (because the consumer
+    died, or failed to write them), they are handed out again.
+    """
+    def __init__(self, path, poll_interval=0.1, retry_after=300):
+        import sqlite3
+        self.poll_interval, self.retry_after = poll_interval, retry_after
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS messages ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, body TEXT NOT NULL, '
+            'taken REAL NOT NULL DEFAULT 0)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS results ('
+            'id INTEGER PRIMARY KEY, body TEXT NOT NULL)')
+        self.connection.commit()
+
+    def _execute(self, func):
+        self.lock.acquire()
+        try:
+            try:
+                result = func(self.connection)
+            except:
+                self.connection.rollback()
+                raise
+            self.connection.commit()
+            return result
+        finally:
+            self.lock.release()
+
+    def put(self, message):
+        body = simplejson.dumps(message)
+        return self._execute(lambda db: db.execute(
+            'INSERT INTO messages (body) VALUES (?)', (body,)).lastrowid)
+
+    def _take(self, db, size):
+        now = time.time()
+        rows = db.execute('SELECT id, body FROM messages WHERE taken <= ? '
+                          'ORDER BY id LIMIT ?',
+                          (now - self.retry_after, size)).fetchall()
+        db.executemany('UPDATE messages SET taken = ? WHERE id = ?',
+                       [(now, id) for id, body in rows])
+        return [dict(simplejson.loads(body), id=id) for id, body in rows]
+
+    def get_batch(self, size, timeout=None):
+        end = timeout is not None and time.time() + timeout
+        while True:
+            batch = self._execute(lambda db: self._take(db, size))
+            if batch or (end is not False and time.time() >= end):
+                return batch
+            time.sleep(self.poll_interval)
+
+    def put_results(self, results):
+        def write(db):
+            db.executemany('INSERT OR REPLACE INTO results (id, body) '
+                           'VALUES (?, ?)', results)
+            db.executemany('DELETE FROM messages WHERE id = ?',
+                           [(id,) for id, body in results])
+        self._execute(write)
+
+    def get_result(self, id):
+        row = self._execute(lambda db: db.execute(
+            'SELECT body FROM results WHERE id = ?', (id,)).fetchone())
+        return row and simplejson.loads(row[0]) or None
+
+class ResultResponse(APIResponse):
+    """
+    Converts the outcome of a call into the result stored in the queue:
+    ``{"result": ...}``, or ``{"error": ..., "status": ...}`` with the data
+    and HTTP status of an ``APIError``.
+    """
+    __slots__ = ()
+    def get_response(self):
+        if isinstance(self.data, APIError):
+            return {'error': self.data.data, 'status': self.http_status}
+        return {'result': self.data}
+
+class QueueDispatcher(Dispatcher):
+    """
+    Consumes call messages from ``queue`` (see ``MemoryQueue`` for the
+    format), and runs them through the regular dispatching: The method is
+    resolved, the key validated, ``process_call`` applied, and deadlines,
+    concurrency limits and diagnostics work as they do for HTTP requests.
+    Views are passed ``None`` as the request.
+
+    Messages are taken in batches of up to ``batch_size``, which are run by
+    ``workers`` threads; the results of a batch are written back together.
+    A result that can't be encoded as JSON is replaced by an error, so that
+    it doesn't take the rest of the batch with it.
+    """
+    default_response_class = ResultResponse
+
+    def __init__(self, api, queue, batch_size=50, workers=4, **kwargs):
+        super(QueueDispatcher, self).__init__(api, **kwargs)
+        self.queue, self.batch_size, self.workers = queue, batch_size, workers
+        self.tasks = Queue.Queue()
+        self.threads = []
+
+    def parse_request(self, context, message):
+        # the message takes the place of the url, and is ``context.url``
+        if not isinstance(message.get('method'), basestring):
+            raise BadRequestError('method missing')
+        path = message['method'].split('.')
+        method = self.api.resolve(path)
+        if method is None:
+            raise MethodNotFoundError(method=path)
+        kwargs = dict([(str(name), value) for name, value in
+                       (message.get('kwargs') or {}).items()])
+        # the key is only passed along if the method checks it
+        plan = method.get_plan()
+        if message.get('key') is not None and plan.check_key:
+            kwargs[plan.key_argument] = message['key']
+        return (method, list(message.get('args') or ()), kwargs)
+
+    def get_deadline(self, context, method):
+        deadline = super(QueueDispatcher, self).get_deadline(context, method)
+        if isinstance(context.url, dict) and context.url.get('deadline'):
+            deadline = min(filter(None, [deadline, context.url['deadline']]))
+        return deadline
+
+    def dispatch_message(self, message):
+        """
+        Runs the call of a single message, and returns it's result.
+        """
+        return self.dispatch(None, message)
+
+    def encode_result(self, result):
+        """
+        Returns the JSON text stored in the queue for ``result``.
+        """
+        try:
+            return simplejson.dumps(result)
+        except (TypeError, ValueError):
+            traceback.print_exc()
+            return simplejson.dumps(ResultResponse(APIError(
+                'result is not serializable')).get_response())
+
+    def _work(self):
+        while True:
+            message, results, done = self.tasks.get()
+            try:
+                try:
+                    result = self.dispatch_message(message)
+                except Exception:
+                    # a bug in a view; the batch carries on
+                    traceback.print_exc()
+                    result = ResultResponse(APIError()).get_response()
+                results.append((message['id'], self.encode_result(result)))
+            finally:
+                done.release()
+
+    def run_batch(self, batch):
+        """
+        Runs the calls of ``batch`` in the worker threads, and writes the
+        results back once all of them are done.
+        """
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+        results, done = [], threading.Semaphore(0)
+        for message in batch:
+            self.tasks.put((message, results, done))
+        for message in batch:
+            done.acquire()
+        self.queue.put_results(results)
+
+    def run(self, stop=None, timeout=1):
+        """
+        Processes batches until ``stop`` (a ``threading.Event``) is set, or,
+        if it is not given, until the queue has been empty for ``timeout``
+        seconds.
+        """
+        while not (stop and stop.isSet()):
+            batch = self.queue.get_batch(self.batch_size, timeout)
+            if batch:
+                self.run_batch(batch)
+            elif stop is None:
+                break
@@ -1,7 +1,9 @@
 # encoding: utf-8
-import types, re
+import types, re, itertools, threading, time, warnings
 from django.http import HttpResponse
 from django.conf import settings
+from coalesce import Coalescer, WaitTimeout, freeze
+from limits import Bulkhead
 
 # TODO: how to handle 404 errors, get_object_or_404() ...
 # TODO: implement signature enforcing (includes types, "int" etc).
@@ -18,9 +20,13 @@ from django.conf import settings
 
 
 __all__ = (
-    'expose', 'conceal', 'check_key', 'process_call',
-    'Namespace', 'GenericAPI', 'Dispatcher', 'APIResponse',
+    'expose', 'conceal', 'check_key', 'process_call', 'coalesce',
+    'lazy_arguments', 'paginate', 'deadline', 'remaining_time',
+    'check_deadline', 'max_concurrency', 'background', 'Namespace',
+    'LazyNamespace', 'GenericAPI', 'Dispatcher', 'APIResponse',
+    'LazyArgument', 'CallContext',
     'APIError', 'BadRequestError', 'MethodNotFoundError', 'InvalidKeyError',
+    'DeadlineExceededError', 'OverloadedError',
 )
 
 def expose(func):
@@ -77,6 +83,244 @@ def process_call(process_call_func):
         return apply_to_func
     return decorator
 
+def coalesce(func):
+    """
+    Opt a method into request coalescing: If multiple identical calls (same
+    method, same arguments) are dispatched concurrently, the view only runs
+    once, and all callers receive the same result and formatted response:
+
+    @expose
+    @coalesce
+    def stats(request, day): return expensive_calculation(day)
+
+    Only use this for methods whose result doesn't depend on the request
+    beyond the call arguments - waiting callers get the response that was
+    built for the request that happened to arrive first. API key validation
+    and ``process_call`` still happen for each request individually. Streamed
+    responses (generator views) can't be shared, so don't use this there.
+
+    Internally, it just adds an attribute to the function object.
+    """
+    func.coalesce = True
+    return func
+
+def lazy_arguments(*names):
+    """
+    Declares arguments that the method wants to receive undecoded, and in
+    some cases may not need to decode at all:
+
+    @expose
+    @lazy_arguments('document')
+    def store(request, id, document):
+        if not exists(id): raise APIError('unknown document')
+        save(id, document.get())
+
+    If the dispatcher used supports it (e.g. ``JsonDispatcher``), the method
+    is passed a ``LazyArgument`` object for each of these arguments, and has
+    to call it's ``get`` method to access the value. Otherwise, the value is
+    passed as usual.
+
+    Internally, it just adds an attribute to the function object.
+    """
+    def decorator(apply_to_func):
+        apply_to_func.lazy_arguments = names
+        return apply_to_func
+    return decorator
+
+def paginate(limit=50):
+    """
+    Opt a method returning a ``QuerySet`` into keyset pagination: Instead of
+    the whole queryset, at most ``limit`` rows are returned, along with a
+    cursor for the next page (``None`` on the last one). To get the next
+    page, the client passes the cursor back in the ``cursor`` argument
+    (see ``Dispatcher.cursor_argument``), which is therefore not passed to
+    the method:
+
+    @expose
+    @paginate(100)
+    def list(request, author):
+        return Comment.objects.filter(author=author).order_by('-date')
+
+    With ``JsonResponse``, the body is ``{"results": [...], "next": ...}``.
+    Results that are not querysets are returned unchanged. See ``Page``.
+
+    Internally, it just adds an attribute to the function object.
+    """
+    def decorator(apply_to_func):
+        apply_to_func.paginate = limit
+        return apply_to_func
+    return decorator
+
+def deadline(seconds):
+    """
+    Gives a method a time budget, overriding the ``timeout`` set in the
+    ``Meta`` options of it's namespace:
+
+    @expose
+    @deadline(2.5)
+    def search(request, query): return slow_search(query)
+
+    Clients can ask for a shorter (but not a longer) budget with a header,
+    see ``Meta.timeout_header``. Once the deadline has passed, calls that
+    have not started yet are answered with a ``DeadlineExceededError``.
+    Code running inside a call can check the deadline with
+    ``remaining_time`` and ``check_deadline``, and calls made through the
+    client from within a view inherit it. ``False`` removes the budget set
+    for the namespace.
+
+    Internally, it just adds an attribute to the function object.
+    """
+    def decorator(apply_to_func):
+        apply_to_func.timeout = seconds
+        return apply_to_func
+    return decorator
+
+def max_concurrency(limit, queue=0):
+    """
+    Limits the number of calls of a method that may be in progress at the
+    same time. Up to ``queue`` further calls wait for their turn (but not
+    beyond their deadline, see ``deadline``), any others are rejected with
+    an ``OverloadedError`` right away:
+
+    @expose
+    @max_concurrency(4, queue=8)
+    def export(request): return build_export()
+
+    The same can be done for all methods of a namespace (and it's
+    sub-namespaces) together, with the ``max_concurrency`` and ``max_queue``
+    options in it's ``Meta``. This keeps an expensive part of the API from
+    occupying every worker thread, and starving everything else. A call
+    has to pass the limits of the method and of each of it's namespaces.
+
+    Internally, it just adds an attribute to the function object.
+    """
+    def decorator(apply_to_func):
+        apply_to_func.max_concurrency = (limit, queue)
+        return apply_to_func
+    return decorator
+
+def background(func):
+    """
+    Makes calls of a long-running method run in the background, instead of
+    keeping the client (and a server thread) waiting:
+
+    @expose
+    @background
+    def yearly_report(request, year): return build_report(year)
+
+    The call is handed to an executor (see ``Meta.job_executor`` and the
+    ``jobs`` module), and answered right away with a ``202 Accepted`` status
+    and the job id; dispatchers that know how to build an url also send a
+    ``Location`` header. The result can then be picked up with the
+    ``jobs.get`` method that is automatically added to the API.
+
+    The API key is validated, and ``process_call`` runs, before the call is
+    accepted. The method should not depend on anything of the request that
+    doesn't survive the end of the request.
+
+    Internally, it just adds an attribute to the function object.
+    """
+    func.background = True
+    return func
+
+# the deadline of the call currently running in a thread
+_local = threading.local()
+
+def remaining_time():
+    """
+    Returns the seconds left until the deadline of the call running in the
+    current thread (which may be negative), or ``None`` if it has none.
+    """
+    deadline = getattr(_local, 'deadline', None)
+    return deadline and deadline - time.time()
+
+def check_deadline():
+    """
+    Raises a ``DeadlineExceededError`` if the deadline of the call running
+    in the current thread has passed. Call this between the steps of a
+    long-running view, to stop working on calls that have been given up on.
+    """
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceededError()
+
+class _StreamScope(object):
+    """
+    Keeps the deadline and the concurrency limits of a call whose view
+    returned a generator for as long as the stream is consumed, since that
+    is when the actual work is done.
+
+    ``finish`` releases the limits and calls the functions registered with
+    ``on_finish``. It runs once the stream is exhausted, fails or is closed,
+    or at the latest when it is garbage collected.
+    """
+    def __init__(self, deadline, bulkheads):
+        self.deadline, self.bulkheads = deadline, bulkheads
+        self.callbacks, self.finished = [], False
+
+    def on_finish(self, func):
+        if self.finished: func()
+        else: self.callbacks.append(func)
+
+    def finish(self):
+        if self.finished: return
+        self.finished = True
+        for bulkhead in self.bulkheads: bulkhead.release()
+        for func in self.callbacks: func()
+
+    def __del__(self):
+        self.finish()
+
+def _guard_stream(items, scope):
+    """
+    Yields the items of the generator ``items``, running it within the
+    deadline of ``scope`` (in whatever thread consumes it).
+    """
+    try:
+        while True:
+            outer_deadline = getattr(_local, 'deadline', None)
+            _local.deadline = scope.deadline
+            try:
+                try:
+                    item = items.next()
+                except StopIteration:
+                    return
+            finally:
+                _local.deadline = outer_deadline
+            yield item
+    finally:
+        items.close()
+        scope.finish()
+
+class LazyArgument(object):
+    """
+    An argument value that is decoded only when it is actually needed.
+    Dispatchers can use this for the arguments they return from
+    ``parse_request``, so that no work is spent on arguments of calls that
+    are rejected anyway (unknown method, invalid key...). The dispatcher
+    decodes all values before the method is called, except those that the
+    method declared via ``lazy_arguments``.
+
+    ``decode`` is called with ``raw`` at most once, and may raise an
+    ``APIError`` if the value is invalid.
+    """
+    __slots__ = ('raw', 'decode', 'value',)
+    def __init__(self, raw, decode):
+        self.raw, self.decode = raw, decode
+    def get(self):
+        try:
+            return self.value
+        except AttributeError:
+            self.value = self.decode(self.raw)
+            return self.value
+    def __eq__(self, other):
+        return isinstance(other, LazyArgument) and \
+               (self.raw, self.decode) == (other.raw, other.decode)
+    def __ne__(self, other):
+        return not self == other
+    def __hash__(self):
+        return hash(self.raw)
+
 class APIError(Exception):
     """
     Base class for all API-related exceptions. Raising ``APIError``s in your
@@ -113,6 +357,23 @@ class APIError(Exception):
     def _set_data(self, value):
         self.__dict__['data'] = value
     data = property(_get_data, _set_data)
+
+    def _is_static(self):
+        """
+        Returns ``True`` if ``data`` is the same for all instances of this
+        class, i.e. no message, code or custom data has been set. Response
+        classes use this to format such errors only once per class.
+        """
+        return not self.message and self._is_default()
+
+    def _is_default(self):
+        """
+        Returns ``True`` if ``data`` is the default ``{"error": ...}``, which
+        differs between instances of this class by the message only.
+        """
+        return not (self.code or
+                    'data' in self.__dict__ or 'name' in self.__dict__) \
+               and type(self).data is APIError.data
     
 class MethodNotFoundError(APIError):
     name = 'Method Not Found'
@@ -125,6 +386,16 @@ class InvalidKeyError(APIError):
     name = 'Invalid API Key'
 class BadRequestError(APIError):
     name = 'Bad Request'
+class OverloadedError(APIError):
+    name = 'Overloaded'
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('http_status', 503)
+        APIError.__init__(self, *args, **kwargs)
+class DeadlineExceededError(APIError):
+    name = 'Deadline Exceeded'
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('http_status', 504)
+        APIError.__init__(self, *args, **kwargs)
 
 class apimethod(object):
     """
@@ -133,17 +404,138 @@ class apimethod(object):
     much less complex (otherwise, we'd attach the attributes to to the function
     object itself, which we have to retrieve via the descriptor protocol
     (__get__) everytime we need access).
+
+    The attributes set by our decorators are copied from the function when
+    the namespace is created, and are held in slots, as they are needed for
+    every call. Any other attributes are looked up on the function, unless
+    they have been set on the method itself.
     """
+    __slots__ = ('func', '_namespace', '_plan', 'exposed', 'check_key',
+                 'process_call', 'coalesce', 'lazy_arguments', 'paginate',
+                 'timeout', 'max_concurrency', 'background', '__dict__',)
+    # attributes copied from the function, and their defaults
+    copied_attrs = (('exposed', None), ('check_key', None),
+                    ('process_call', None), ('coalesce', False),
+                    ('lazy_arguments', ()), ('paginate', None),
+                    ('timeout', None), ('max_concurrency', None),
+                    ('background', False),)
+    copied_names = frozenset([name for name, default in copied_attrs])
+
     def __init__(self, func):
-        self.func = func
+        object.__setattr__(self, 'func', func)
+        object.__setattr__(self, '_namespace', None)
+        object.__setattr__(self, '_plan', None)
+        for name, default in self.copied_attrs:
+            object.__setattr__(self, name, getattr(func, name, default))
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        # the call plans and lookups are derived from these
+        if name in self.copied_names:
+            _api_changed()
     def __call__(self, *args, **kwargs):
       return self.func(*args, **kwargs)
     def __getattr__(self, name):
         """
-        Fall back to function object itself. Attributes set via decorators are
-        usually found there.
+        Fall back to function object itself, for everything not copied.
         """
         return getattr(self.func, name)
+    def get_plan(self):
+        """
+        Returns the ``CallPlan`` for this method, which is only rebuilt when
+        the API has been modified.
+        """
+        plan = self._plan
+        if plan is None or plan.version != _api_version:
+            plan = self._plan = CallPlan(self)
+        return plan
+
+# Incremented whenever a namespace or it's options are modified, so that
+# information derived from the structure of an API can be invalidated.
+_versions = itertools.count(1)
+_api_version = 0
+# Changes that only affect a single API (namespaces being loaded into it)
+# increment the version of that API instead, so that the call plans and
+# lookups of every other API are kept.
+_api_versions = {}
+def _api_changed(api=None):
+    # ``count`` hands out each value only once, even to concurrent threads
+    global _api_version
+    if api is None:
+        _api_version = _versions.next()
+    else:
+        _api_versions[api] = _versions.next()
+
+def _get_version(api):
+    # changes with every change to any API, and those to ``api`` alone
+    return (_api_version, _api_versions.get(api, 0))
+
+class CallPlan(object):
+    """
+    The options that are in effect for calls to a method, as determined from
+    the method itself and the options of it's namespace (and their parents):
+    How to validate the API key, which ``process_call`` handler to use, the
+    time budget and the concurrency limits.
+    """
+    def __init__(self, method):
+        self.version = _api_version
+        # helper that returns the first "not None" item of a sequence
+        first = lambda *a: filter(lambda x: x is not None, a)[0]
+
+        # If there is no method-specific key validator, use the one from the
+        # namespace. Note that ``False`` means key auth is not required for
+        # this call.
+        meta = method._namespace._meta
+        self.check_key = getattr(method, 'check_key', None)
+        if self.check_key is None:
+            self.check_key = meta.check_key
+        # where to look for the key, in arguments and http headers
+        self.key_argument = first(meta.key_argument, 'apikey')
+        self.key_header = first(meta.key_header, 'X-APIKEY')
+        if self.key_header: self.key_header = 'HTTP_'+self.key_header
+
+        self.process_call = getattr(method, 'process_call', None)
+        if self.process_call is None:
+            self.process_call = meta.process_call
+
+        # the time budget, and where clients can ask for a shorter one
+        self.timeout = first(getattr(method, 'timeout', None), meta.timeout,
+                             False)
+        self.timeout_header = first(meta.timeout_header, 'X-Timeout')
+        if self.timeout_header:
+            self.timeout_header = \
+                'HTTP_' + self.timeout_header.upper().replace('-', '_')
+
+        self.job_executor = meta.job_executor
+
+        # the concurrency limits of the method, and of every namespace it is
+        # in that sets one (not inherited, as they are shared by all methods
+        # of the namespace that sets them).
+        self.bulkheads = []
+        if getattr(method, 'max_concurrency', None):
+            self.bulkheads.append(_bulkhead(method, *method.max_concurrency))
+        while meta:
+            limit = object.__getattribute__(meta, 'max_concurrency')
+            if limit:
+                self.bulkheads.append(_bulkhead(meta, limit,
+                    object.__getattribute__(meta, 'max_queue') or 0))
+            meta = object.__getattribute__(meta, 'parent')
+
+_bulkheads, _bulkheads_lock = {}, threading.Lock()
+def _bulkhead(owner, limit, queue):
+    """
+    Returns the ``Bulkhead`` for a method or namespace, which is only
+    replaced if the limits have changed.
+    """
+    # plans are rebuilt concurrently; all of them need to get the same one
+    _bulkheads_lock.acquire()
+    try:
+        bulkhead = _bulkheads.get(owner)
+        if bulkhead is None or \
+           (bulkhead.limit, bulkhead.queue) != (limit, queue):
+            bulkhead = _bulkheads[owner] = Bulkhead(limit, queue)
+        return bulkhead
+    finally:
+        _bulkheads_lock.release()
 
 class NamespaceOptions(object):
     """
@@ -154,6 +546,11 @@ class NamespaceOptions(object):
         self.expose_by_default = getattr(options, 'expose_by_default', None)
         self.key_header = getattr(options, 'key_header', None)
         self.key_argument = getattr(options, 'key_argument', None)
+        self.timeout = getattr(options, 'timeout', None)
+        self.timeout_header = getattr(options, 'timeout_header', None)
+        self.max_concurrency = getattr(options, 'max_concurrency', None)
+        self.max_queue = getattr(options, 'max_queue', None)
+        self.job_executor = getattr(options, 'job_executor', None)
         check_key = getattr(options, 'check_key', None)
         self.check_key = check_key and check_key.im_func or check_key
         process_call = getattr(options, 'process_call', None)
@@ -170,6 +567,59 @@ class NamespaceOptions(object):
         if val is None and parent:
             return getattr(parent, attr)
         return val
+    def __setattr__(self, attr, value):
+        # nothing can be derived yet from options still being set up, or
+        # from those of a namespace that is not part of an API yet
+        values = super(NamespaceOptions, self).__getattribute__('__dict__')
+        initial = not attr in values or \
+                  (attr == 'parent' and values['parent'] is None)
+        super(NamespaceOptions, self).__setattr__(attr, value)
+        if not initial:
+            _api_changed()
+
+class LazyNamespace(object):
+    """
+    Stands in for a namespace that is only imported when a call is made
+    into it, to keep large APIs from loading every module up front:
+
+    class MyAPI(GenericAPI):
+        reports = LazyNamespace('myapp.reports.api.ReportsNamespace')
+
+    ``path`` is the dotted path to the ``Namespace`` class. On the first
+    ``resolve`` that walks into it, the class is imported, hooked into the
+    API like a regular sub-namespace, and replaces this object. Until then,
+    it's methods are not part of the API as seen by ``GenericAPI.prepare``.
+
+    Loading only invalidates what has been derived from the API it was
+    loaded through. Other APIs the namespace is part of still find it's
+    methods, but without the help of their lookups and routes.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.owner = self.name = self.namespace = None
+        self.lock = threading.Lock()
+
+    def load(self, api):
+        """
+        Imports the namespace (once), and returns it. ``api`` is the API
+        it is loaded through.
+        """
+        self.lock.acquire()
+        try:
+            if self.namespace is None:
+                module, sep, name = self.path.rpartition('.')
+                namespace = getattr(__import__(module, {}, {}, [name]), name)
+                if not (isinstance(namespace, type) and
+                        issubclass(namespace, Namespace)):
+                    raise TypeError('%s is not a namespace' % self.path)
+                namespace._meta.parent = self.owner._meta
+                # only the lookups and routes of ``api`` need to be rebuilt
+                type.__setattr__(self.owner, self.name, namespace)
+                _api_changed(api)
+                self.namespace = namespace
+            return self.namespace
+        finally:
+            self.lock.release()
 
 class Namespace(object):
     """
@@ -216,9 +666,41 @@ class NamespaceMetaclass(type):
             # this is the code that requires the ``Namespace`` forward decl
             elif isinstance(attr, type) and issubclass(attr, Namespace):
                 attr._meta.parent = self._meta
-                
+            elif isinstance(attr, LazyNamespace):
+                attr.owner, attr.name = self, a
+
+        # APIs with ``background`` methods get a namespace to poll the jobs
+        api_class = globals().get('GenericAPI')
+        if api_class and issubclass(self, api_class) and \
+           not 'jobs' in attrs and _has_background(self, set()):
+            type.__setattr__(self, 'jobs', _jobs_namespace(self))
+
         return self
 
+    def __setattr__(cls, name, value):
+        type.__setattr__(cls, name, value)
+        _api_changed()
+    def __delattr__(cls, name):
+        type.__delattr__(cls, name)
+        _api_changed()
+
+def _jobs_namespace(api):
+    from jobs import jobs_namespace
+    namespace = jobs_namespace(api)
+    namespace._meta.parent = api._meta
+    return namespace
+
+def _has_background(namespace, seen):
+    seen.add(namespace)
+    for obj in namespace.__mro__:
+        for attr in obj.__dict__.values():
+            if isinstance(attr, apimethod):
+                if attr.background: return True
+            elif isinstance(attr, type) and issubclass(attr, Namespace) \
+                 and not attr in seen:
+                if _has_background(attr, seen): return True
+    return False
+
 class Namespace(object):
     """
     Just used to identify the inner classes we care about. This allows the use
@@ -228,6 +710,84 @@ class Namespace(object):
     """
     __metaclass__ = NamespaceMetaclass
 
+class _Lookup(object):
+    """
+    Used by ``GenericAPI.resolve`` to reject unknown paths without searching
+    through the API: Knows all names of methods and namespaces used in an API,
+    and remembers a limited number of paths that could not be resolved.
+
+    Has to be rebuilt when the API changes, see ``_api_changed``.
+
+    Paths longer than the deepest method path can't resolve either, and are
+    not remembered, so that the memory the misses take stays bounded no
+    matter which paths clients send.
+    """
+    max_misses = 1000
+
+    def __init__(self, api):
+        self.version = _get_version(api)
+        self.misses = {}
+        self.lock = threading.Lock()
+        self.names = set()
+        # names of the namespaces not loaded yet, which may contain anything
+        self.lazy = set()
+        self.depth = self._collect(api, set())
+
+    def _collect(self, namespace, seen):
+        # returns the length of the longest path in ``namespace``
+        seen.add(namespace)
+        depth = 0
+        for obj in namespace.__mro__:
+            for name, attr in obj.__dict__.items():
+                if isinstance(attr, apimethod):
+                    self.names.add(name)
+                    depth = max(depth, 1)
+                elif isinstance(attr, type) and issubclass(attr, Namespace):
+                    self.names.add(name)
+                    if not attr in seen:
+                        depth = max(depth, self._collect(attr, seen) + 1)
+                elif isinstance(attr, LazyNamespace):
+                    self.names.add(name)
+                    self.lazy.add(name)
+        return depth
+
+    @classmethod
+    def get(cls, api):
+        lookup = _lookups.get(api)
+        if lookup is None or lookup.version != _get_version(api):
+            lookup = _lookups[api] = cls(api)
+        return lookup
+
+    def add_miss(self, path):
+        if len(path) > self.depth:
+            return
+        self.lock.acquire()
+        try:
+            # rather than tracking usage, simply start over once full
+            if len(self.misses) >= self.max_misses:
+                self.misses.clear()
+            self.misses[path] = True
+        finally:
+            self.lock.release()
+
+_lookups = {}
+_clients = {}
+
+def _iter_paths(namespace, prefix=(), chain=()):
+    """
+    Yields the paths of all methods in ``namespace`` and it's children,
+    exposed or not, including those that are hidden by a subclass.
+    """
+    chain += (namespace,)
+    for obj in namespace.__mro__:
+        for name, attr in obj.__dict__.items():
+            if isinstance(attr, apimethod):
+                yield prefix + (name,)
+            elif isinstance(attr, type) and issubclass(attr, Namespace) \
+                 and not attr in chain:
+                for path in _iter_paths(attr, prefix + (name,), chain):
+                    yield path
+
 class GenericAPI(Namespace):
     """
     Baseclass for an API.
@@ -269,7 +829,20 @@ class GenericAPI(Namespace):
         Returns the exposed method specified in the list (or tuple) in path, or
         None if the path could not be resolved, or the method targeted is not
         exposed.
+
+        Paths that contain a name which doesn't occur anywhere in the API,
+        or that have failed to resolve before, are rejected right away.
         """
+        lookup = _Lookup.get(self)
+        path = tuple(path)
+        if not path:
+            return None
+        if path in lookup.misses:
+            return None
+        if not lookup.lazy.intersection(path) and \
+           (len(path) > lookup.depth or not lookup.names.issuperset(path)):
+            return None
+
         def _find(obj, index=0):
             name = path[index]
 
@@ -285,7 +858,16 @@ class GenericAPI(Namespace):
                 if name in obj.__dict__:
                     # if we don't have resolved the complete path yet, continue
                     if index < len(path)-1:
-                        attr = _find(obj.__dict__[name], index+1)
+                        attr = obj.__dict__[name]
+                        if isinstance(attr, LazyNamespace):
+                            attr = attr.load(self)
+                            # the API may only now have background methods
+                            if not hasattr(self, 'jobs') and \
+                               _has_background(attr, set()):
+                                type.__setattr__(self, 'jobs',
+                                                 _jobs_namespace(self))
+                                _api_changed(self)
+                        attr = _find(attr, index+1)
                         # if we found something, return it, otherwise continue
                         if attr: return attr
 
@@ -295,13 +877,42 @@ class GenericAPI(Namespace):
                     else:
                         method = obj.__dict__[name]
                         if isinstance(method, apimethod):
-                            if getattr(method, 'exposed', obj._meta.expose_by_default):
+                            exposed = method.exposed
+                            if exposed is None:
+                                exposed = obj._meta.expose_by_default
+                            if exposed:
                                 return method
             # backtrack
             return None
 
         # from the root namespace (self), traverse the class hierarchy
-        return _find(self)
+        method = _find(self)
+        if method is None:
+            lookup.add_miss(path)
+        return method
+
+    @classmethod
+    def prepare(self):
+        """
+        Does all the work that would otherwise be done lazily while handling
+        the first requests: Builds the data ``resolve`` uses, resolves every
+        method path, and determines the options in effect for each exposed
+        method. Call this when a worker process starts, or in the master
+        before forking, so that live traffic doesn't pay for it.
+
+        Returns the paths of all exposed methods, as tuples. Note that the
+        work needs to be redone if the API is modified afterwards.
+        """
+        _Lookup.get(self)
+        paths, seen = [], set()
+        for path in _iter_paths(self):
+            if path in seen: continue
+            seen.add(path)
+            method = self.resolve(path)
+            if method:
+                method.get_plan()
+                paths.append(path)
+        return paths
 
     @classmethod
     def execute(self, method, *args, **kwargs):
@@ -311,10 +922,29 @@ class GenericAPI(Namespace):
         automatically, but this might break your views, of course.
         """
         response_class = kwargs.pop('response_class', None)
-        request = kwargs.pop('request', None)
-        from dispatch import SimpleDispatcher
-        return SimpleDispatcher(self, response_class).dispatch(
-            method, request, *args, **kwargs)
+        return self.get_client(response_class).call(
+            method.split('.'), args, kwargs)
+
+    @classmethod
+    def get_client(self, response_class=None):
+        """
+        Returns the in-process client for this API, which allows calling
+        methods via attribute access:
+
+        client = MyAPI.get_client()
+        client.comments.add("great post", request=request)
+
+        API key validation and ``process_call`` handlers apply as they would
+        for any other dispatcher. Errors are raised, unless a
+        ``response_class`` is used. The client is created once and then
+        shared.
+        """
+        key = (self, response_class)
+        client = _clients.get(key)
+        if client is None:
+            from client import Client
+            client = _clients[key] = Client(self, response_class)
+        return client
             
 class APIResponse(object):
     """
@@ -335,6 +965,7 @@ class APIResponse(object):
     See also ``APIError``, which has a partly similar interface.
     """
     # TODO: rename to ``Response``?
+    __slots__ = ('data', 'http_status', 'http_headers',)
     def __init__(self, data, http_status=None, http_headers=None):
         # If another response object is passed, clone it; this allows the
         # dispatcher code to handle ``APIResponse`` objects from a view like
@@ -368,10 +999,20 @@ class APIResponse(object):
                 response[key] = value
         return response
 
+    @classmethod
+    def prepare(cls):
+        """
+        Called by ``Dispatcher.warm``. Child classes can use this to do their
+        imports and other setup in advance.
+        """
+        pass
+
     def format(self, data):
         """
         Child classes need to provide this method to prepare ``data`` for use
-        as the content of a ``HttpResponse``. Should return a string.
+        as the content of a ``HttpResponse``. Should return a string, or an
+        iterable of string chunks: These are handed to the server one by one,
+        which avoids joining large bodies into yet another string.
 
         Usually, ``data`` is base python structure that needs to be serialized.
         Although there are no precise requirements as to what datatypes need to
@@ -402,10 +1043,30 @@ class Dispatcher(object):
         (r'^api/xmlrpc/(.*)$',
                 XmlRpcDispatcher(MyAPI, response_class=JsonResponse)),
     )
+
+    Thread-safety: A dispatcher instance is shared by all the requests it
+    handles, and is safe to use from multiple threads at once. Dispatchers
+    never store per-call state on themselves (or on the request); everything
+    that needs to be passed along while a call is processed lives in the
+    ``CallContext`` given to each hook. Child classes must follow the same
+    rule. The caches shared between calls (method lookups, call plans, error
+    bodies) are replaced as a whole, except for the paths known not to
+    resolve, a bounded set that is updated under a lock; request coalescing
+    uses a lock as well. Namespaces and their options are set up when the
+    API classes are created; modifying them while requests are served is
+    possible, but not recommended.
+
+    Compatibility: The hooks (``parse_request``, ``preprocess_call``,
+    ``call``, ``make_response``, ...) are passed a ``CallContext`` as their
+    first argument, where they used to get the request; it is available as
+    ``context.request``. Reading other attributes of the request from the
+    context still works, but raises a ``DeprecationWarning``.
     """
 
     # Child classes can specify this
     default_response_class = None
+    # the argument passing the cursor to methods using ``paginate``
+    cursor_argument = 'cursor'
 
     # TODO: Do we want to support allowing/disallow authenticiation (key and
     # other) via headers or arguments. It's currently configured via the Meta
@@ -415,28 +1076,53 @@ class Dispatcher(object):
         self.api = api
         if response_class is None: response_class = self.default_response_class
         self.response_class = response_class
+        self.coalescer = Coalescer()
+        # e.g. an ``AllocationTracker``, see the ``diagnostics`` module
+        self.diagnostics = None
 
     def __call__(self, *args, **kwargs):
         return self.dispatch(*args, **kwargs)
 
-    def parse_request(self, request, url):
+    def warm(self):
+        """
+        Prepares the API (see ``GenericAPI.prepare``) and the response class
+        ahead of the first request. Returns the exposed method paths.
+        """
+        if self.response_class:
+            self.response_class.prepare()
+        return self.api.prepare()
+
+    def create_context(self, request, url=None):
+        """
+        Returns the ``CallContext`` for a new call. Child classes can
+        override this to initialize the additional attributes they need.
+        """
+        return CallContext(request, url)
+
+    def parse_request(self, context, url):
         """
         Override this when implementing a dispatcher. Must return a 3-tuple(!)
         of (path, args, kwargs), with path being a list or tuple pointing
         to the requested method (see also GenericAPI.resolve).
 
+        Instead of the path, the tuple may also contain the method itself,
+        if the dispatcher has already resolved it.
+
         The function can also return a list(!) of such 3-tuples if a unique
         call cannot be determined. However, make sure the variants are always
         exclusive. A situation where a wrong method could accidentally be must
         not arise.
 
+        The request is available as ``context.request``. Anything else found
+        that needs to be passed along should be stored on ``context`` as well.
+
         Should a problem occur that prevents from returning a meaningful result,
         raise a ``BadRequestError``.
         """
         raise NotImplementedError()
     del parse_request
     
-    def make_response(self, requesst, response_class, data, *args, **kwargs):
+    def make_response(self, context, response_class, data, *args, **kwargs):
         """
         Create an instance of ``response_class`` with ``data`` and all other
         passed arguments.
@@ -446,38 +1132,41 @@ class Dispatcher(object):
         """
         return response_class(data, *args, **kwargs)
     
-    def preprocess_call(self, request, method, args, kwargs):
+    def decode_arguments(self, context, method, args, kwargs):
+        """
+        Replaces the ``LazyArgument`` values in ``kwargs`` by their decoded
+        values, unless the method has asked to receive them as they are (see
+        ``lazy_arguments``). Called after the API key has been validated.
+        """
+        lazy = getattr(method, 'lazy_arguments', ())
+        for name, value in kwargs.items():
+            if isinstance(value, LazyArgument) and not name in lazy:
+                kwargs[name] = value.get()
+
+    def preprocess_call(self, context, method, args, kwargs):
         """
         Do  some preprocessing before a method is actually called. This checks
         the API key, and also calls an API's ``process_call``, if defined.
         
         This is in a separate method to give child classes more hooks.
         """
-        # helper that returns the first "not None" item of a sequence
-        first = lambda *a: filter(lambda x: x is not None, a)[0]
+        request = context.request
 
         # Validate api key: first, check if we we need to require a key at
-        # all, and if so, what the function doing the validation is. If
-        # there is no method-specific validator, try the one from the
-        # namespace. Note that ``False`` means key auth is not required
-        # for this call.
-        meta = method._namespace._meta
-        check_key = getattr(method, 'check_key', None)
-        if check_key is None:
-            check_key = meta.check_key
-        # find the correct key to use, from arguments and http headers
-        if check_key:
-            key_header = first(meta.key_header, 'X-APIKEY')
-            if key_header: key_header =  'HTTP_'+key_header
-            key = kwargs.pop(first(meta.key_argument, 'apikey'), None) or \
-                  request and request.META.get(key_header)
-            if not check_key(request, key):
+        # all, and if so, find the correct key to use, from arguments and
+        # http headers.
+        plan = method.get_plan()
+        if plan.check_key:
+            key = kwargs.pop(plan.key_argument, None)
+            if isinstance(key, LazyArgument): key = key.get()
+            key = key or request and request.META.get(plan.key_header)
+            if not plan.check_key(request, key):
                 raise InvalidKeyError()
 
+        # decode remaining arguments, now that we know they are needed
+        self.decode_arguments(context, method, args, kwargs)
+
         # handle pre-processing
-        process_call = getattr(method, 'process_call', None)
-        if process_call is None:
-            process_call = meta.process_call
         # If a pre-processors was found, call it first. call processors
         # may raise exceptions, or return a new ``apimethod`` object
         # that will be called instead. Additionally, a return value of
@@ -486,8 +1175,8 @@ class Dispatcher(object):
         # note that we cannot let the processor call the api view itself.
         # As ``None`` is a valid response for api views, we would not be
         # able to determine whether that has been done or not.
-        if process_call:
-            process_result = process_call(request, method, args, kwargs)
+        if plan.process_call:
+            process_result = plan.process_call(request, method, args, kwargs)
             if process_result is False:
                 raise BadRequestError()
             elif process_result is True:
@@ -498,6 +1187,32 @@ class Dispatcher(object):
         # return method (might have been modified)
         return method
 
+    def coalesce_key(self, context, method, args, kwargs):
+        """
+        Returns the key under which a call to a ``@coalesce`` method is
+        shared with other concurrent calls, or ``None`` if this particular
+        call should not be coalesced.
+
+        Child classes need to extend the key if the response depends on
+        other parts of the request as well. The key includes the dispatcher,
+        since dispatchers sharing a coalescer (see ``MultiDispatcher``) may
+        build different responses for the same call.
+        """
+        key = freeze((method, args, kwargs))
+        return key and (self, key)
+
+    def copy_response(self, response):
+        """
+        Called for each request that waited for a coalesced call to get it's
+        own copy of the finished response.
+        """
+        if isinstance(response, HttpResponse):
+            copy = HttpResponse(response.content, status=response.status_code)
+            for key, value in response.items():
+                copy[key] = value
+            return copy
+        return response
+
     def dispatch(self, request, url=None):
         """
         Resolves an incoming request to an API call, calls the method, and
@@ -506,50 +1221,245 @@ class Dispatcher(object):
 
         ``request`` is a Django ``Request`` object. ``url`` is the sub-url of
         the request to be resolved. If it is missing, ``request.path`` is used.
+
+        If ``diagnostics`` is set, it's ``start`` and ``stop`` methods are
+        called around the whole call, including the formatting of the
+        response; for streamed results, until the stream has been consumed.
         """
         if not hasattr(self, 'parse_request'):
             raise NotImplementedError()
 
-        method = None
+        context = self.create_context(request, url or request.path)
+        diagnostics = self.diagnostics
+        if diagnostics is None:
+            return self._dispatch(context)
+        started = diagnostics.start()
         try:
-            parsed = self.parse_request(request, url or request.path)
+            return self._dispatch(context)
+        finally:
+            method = context.method
+            stop = lambda: diagnostics.stop(method, started)
+            # streams are measured until they have been consumed
+            if context.stream is not None: context.stream.on_finish(stop)
+            else: stop()
+
+    def _dispatch(self, context):
+        try:
+            parsed = self.parse_request(context, context.url)
             if isinstance(parsed, tuple): parsed = [parsed]
 
             # try to resolve to a method call by trying all the
             # different options in order
             method = None
             for path, args, kwargs in parsed:
-                method = self.api.resolve(path)
+                if isinstance(path, apimethod):
+                    method = path
+                else:
+                    method = self.api.resolve(path)
                 if method: break;
             if method is None:
                 raise MethodNotFoundError(method=path)
+        except APIError, e:
+            return self.respond(context, self.process_error(context, e))
+        return self.dispatch_method(context, method, args, kwargs)
 
-            # check api key, do call pre-processing
-            method = self.preprocess_call(request, method, args, kwargs)
-
-            # call the first method found
+    def dispatch_method(self, context, method, args, kwargs):
+        """
+        Calls an already resolved ``method``, after checking the API key and
+        doing the call pre-processing, and returns the final response.
+        """
+        context.method = method
+        try:
+            context.deadline = self.get_deadline(context, method)
+            method = context.method = \
+                self.preprocess_call(context, method, args, kwargs)
+        except APIError, e:
+            return self.respond(context, self.process_error(context, e))
+
+        # identical calls of a coalesced method that are already in progress
+        # are joined, and share the view call as well as the response.
+        if getattr(method, 'coalesce', False):
+            key = self.coalesce_key(context, method, args, kwargs)
+            if key is not None:
+                try:
+                    return self.coalescer.run(key,
+                        lambda: self.call(context, method, args, kwargs),
+                        share=self.copy_response,
+                        timeout=context.deadline and
+                                max(context.deadline - time.time(), 0))
+                except WaitTimeout:
+                    return self.respond(context, self.process_error(
+                        context, DeadlineExceededError()))
+        return self.call(context, method, args, kwargs)
+
+    def get_deadline(self, context, method):
+        """
+        Returns the time by which the call has to be finished, or ``None``:
+        The earliest of the deadline of the method's time budget, the one
+        requested by the client, and that of the call this one is made from,
+        if any.
+        """
+        plan = method.get_plan()
+        request = context.request
+        timeouts = [plan.timeout]
+        value = plan.timeout_header and request and \
+                request.META.get(plan.timeout_header)
+        if value:
             try:
-                # TODO: Check and compare method signatures to allow for more
-                # detailed error messages ("argument X not supported" etc.)
-                # finally, call the function itself.
-                result = method(request, *args, **kwargs)
-            except TypeError, e:
-                if settings.DEBUG: raise BadRequestError(str(e))
-                else: raise BadRequestError()
+                timeouts.append(float(value))
+            except ValueError:
+                raise BadRequestError('invalid timeout: %s' % value)
+        deadlines = [time.time() + t for t in timeouts if t is not False] + \
+                    [getattr(_local, 'deadline', None)]
+        deadlines = filter(None, deadlines)
+        return deadlines and min(deadlines) or None
+
+    def call(self, context, method, args, kwargs):
+        """
+        Calls the (already resolved and preprocessed) ``method`` and returns
+        the final response.
+        """
+        try:
+            if method.background:
+                result = self.submit_job(context, method, args, kwargs)
+            else:
+                result = self.invoke(context, method, args, kwargs)
 
         # Catch our own errors only. Everything else will bubble up to Django's
         # exception handling. If you don't want that, you can always write a
         # custom dispatcher and let it handle or preprocess the rest (e.g.
         # convert all exceptions to ``APIError``s before passing them along).
         except APIError, e:
-            # try to find a custom error formatting function
-            meta = method and method._namespace._meta or self.api._meta
-            if meta.format_error:
-                e.data = meta.format_error(request, e)
-            # use the exception as the data object; response classes need to
-            # be able to handle that.
-            result = e
+            result = self.process_error(context, e)
+
+        return self.respond(context, result)
+
+    def invoke(self, context, method, args, kwargs):
+        """
+        Runs the view of ``method`` (within it's deadline and concurrency
+        limits), and returns the result. ``APIError``s are raised.
 
+        If the view returns a generator, the deadline and the limits apply
+        to the consumption of the generator instead, see ``context.stream``.
+        """
+        if method.paginate:
+            cursor = kwargs.pop(self.cursor_argument, None)
+            if isinstance(cursor, LazyArgument): cursor = cursor.get()
+        # don't start working on a call that has been given up on
+        if context.deadline and context.deadline <= time.time():
+            raise DeadlineExceededError()
+        acquired = self.acquire_bulkheads(context, method)
+        outer_deadline = getattr(_local, 'deadline', None)
+        _local.deadline = context.deadline
+        try:
+            # TODO: Check and compare method signatures to allow for more
+            # detailed error messages ("argument X not supported" etc.)
+            # finally, call the function itself.
+            result = method(context.request, *args, **kwargs)
+            response = isinstance(result, APIResponse) and result or None
+            items = response and response.data or result
+            if isinstance(items, types.GeneratorType):
+                # the limits are released when the stream is done
+                context.stream = _StreamScope(context.deadline, acquired)
+                items = _guard_stream(items, context.stream)
+                if response: response.data = items
+                else: result = items
+        except TypeError, e:
+            if settings.DEBUG: raise BadRequestError(str(e))
+            else: raise BadRequestError()
+        finally:
+            _local.deadline = outer_deadline
+            if context.stream is None:
+                for bulkhead in acquired: bulkhead.release()
+        if method.paginate:
+            result = self.paginate(context, method, result, cursor)
+        return result
+
+    def submit_job(self, context, method, args, kwargs):
+        """
+        Hands a call of a ``background`` method to the executor, and returns
+        the ``202 Accepted`` response.
+        """
+        from jobs import Job, store, default_executor
+        job = Job(self.api)
+        # the job is not bound to the deadline of the request
+        job_context = self.create_context(context.request, context.url)
+        job_context.method = method
+        def run():
+            try:
+                return self.invoke(job_context, method, args, kwargs)
+            except APIError, e:
+                return self.process_error(job_context, e)
+        store.add(job)
+        executor = method.get_plan().job_executor or default_executor()
+        executor.submit(lambda: job.run(run))
+        location = self.job_location(context, job)
+        return APIResponse({'id': job.id}, http_status=202,
+                           http_headers=location and {'Location': location})
+
+    def job_location(self, context, job):
+        """
+        Returns the url of the ``jobs.get`` call for ``job``, or ``None``
+        if the dispatcher can't tell.
+        """
+        return None
+
+    def acquire_bulkheads(self, context, method):
+        """
+        Waits for the concurrency limits of ``method`` (see
+        ``max_concurrency``) to admit the call, and returns the bulkheads
+        that need to be released when the call is done. Raises an
+        ``OverloadedError`` if the call is turned away, or a
+        ``DeadlineExceededError`` if the deadline passes while waiting.
+        """
+        acquired = []
+        for bulkhead in method.get_plan().bulkheads:
+            timeout = context.deadline and \
+                      max(context.deadline - time.time(), 0)
+            if not bulkhead.acquire(timeout):
+                for other in acquired: other.release()
+                if context.deadline and context.deadline <= time.time():
+                    raise DeadlineExceededError()
+                raise OverloadedError()
+            acquired.append(bulkhead)
+        return acquired
+
+    def paginate(self, context, method, result, cursor):
+        """
+        Returns the ``Page`` of ``result`` starting at ``cursor``, for a
+        method using ``paginate``. ``result`` may have been wrapped in an
+        ``APIResponse`` by the view.
+        """
+        from django.db.models.query import QuerySet
+        from pagination import Page
+        if isinstance(result, APIResponse):
+            if isinstance(result.data, QuerySet):
+                result = APIResponse(result)
+                result.data = Page(result.data, cursor, method.paginate)
+        elif isinstance(result, QuerySet):
+            result = Page(result, cursor, method.paginate)
+        return result
+
+    def process_error(self, context, error):
+        """
+        Prepares an ``APIError`` raised during the call to be used as the
+        response data.
+        """
+        # try to find a custom error formatting function; ``context.method``
+        # is ``None`` if the error occured before a method was resolved.
+        method = context.method
+        meta = method and method._namespace._meta or self.api._meta
+        if meta.format_error:
+            error.data = meta.format_error(context.request, error)
+        # use the exception as the data object; response classes need to
+        # be able to handle that.
+        return error
+
+    def respond(self, context, result):
+        """
+        Converts ``result`` into the final response using the dispatcher's
+        response class.
+        """
         response_class = self.response_class
         # if no response class is available (which usually means that the user
         # as explicitly passed ``None``, as dispatcher should provide a
@@ -558,4 +1468,37 @@ class Dispatcher(object):
             from response import PythonResponse
             response_class = PythonResponse
 
-        return self.make_response(request, response_class, result).get_response()
\ No newline at end of file
+        return self.make_response(context, response_class, result).get_response()
+
+class CallContext(object):
+    """
+    Holds the state of a single call while it is being dispatched. A new
+    instance is created for every call, and passed to all the dispatcher
+    hooks, so that dispatchers, which are shared between requests and
+    threads, don't need to keep anything per call themselves.
+
+    ``request`` is the Django request (which may be ``None``), ``url`` what
+    the dispatcher is resolving, and ``method`` the ``apimethod`` that is
+    being called, once known. ``deadline`` is the time (as returned by
+    ``time.time``) by which the call has to be finished, or ``None``.
+    ``stream`` is set if the view returned a generator, and holds on to the
+    deadline and concurrency limits until the stream has been consumed.
+    Dispatchers are free to add attributes of their own.
+
+    Dispatcher hooks used to be passed the request instead. So that child
+    classes written for that keep working, attributes the context doesn't
+    have are looked up on the request, with a ``DeprecationWarning``.
+    """
+    def __init__(self, request, url=None):
+        self.request, self.url, self.method = request, url, None
+        self.deadline = self.stream = None
+
+    def __getattr__(self, name):
+        request = self.__dict__.get('request')
+        if name.startswith('__') or request is None:
+            raise AttributeError(name)
+        value = getattr(request, name)
+        warnings.warn('dispatcher hooks are passed a CallContext; use '
+                      'context.request.%s' % name, DeprecationWarning,
+                      stacklevel=2)
+        return value
@@ -0,0 +1,271 @@
+"""
+Diagnostics that can be enabled on a dispatcher at runtime, without a
+profiler:
+
+    dispatcher.diagnostics = AllocationTracker()
+    ...
+    dispatcher.diagnostics.report(MyAPI)
+
+A tracker has ``start`` and ``stop`` methods, which the dispatcher calls
+around each call, and ``report``, which returns the numbers collected, as a
+dict keyed by method path.
+"""
+
+import gc, re, time, threading
+
+__all__ = (
+    'AllocationTracker', 'QueryTracker', 'CombinedTracker', 'fingerprint',
+)
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+class _Tracker(object):
+    """
+    Base class for trackers, which collect a dict of numbers per method.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def start(self):
+        """
+        Called before a call is dispatched; returns the state to pass to
+        ``stop``.
+        """
+        raise NotImplementedError()
+
+    def stop(self, method, started):
+        """
+        Called after a call to ``method`` (``None`` if it could not be
+        resolved) has been dispatched.
+        """
+        raise NotImplementedError()
+
+    def record(self, method, func):
+        """
+        Calls ``func`` with the stats of ``method``, which it may update,
+        while holding the lock.
+        """
+        self.lock.acquire()
+        try:
+            stats = self.stats.get(method)
+            if stats is None:
+                stats = self.stats[method] = self.new_stats()
+            func(stats)
+        finally:
+            self.lock.release()
+
+    def report(self, api):
+        """
+        Returns the recorded numbers as a dict, keyed by the dotted method
+        path ("<unresolved>" for calls that did not resolve to a method).
+        """
+        names = {}
+        for path in api.prepare():
+            names.setdefault(api.resolve(path), '.'.join(path))
+        self.lock.acquire()
+        try:
+            stats = self.stats.items()
+        finally:
+            self.lock.release()
+
+        report = {}
+        for method, values in stats:
+            name = method is None and '<unresolved>' or \
+                   names.get(method, repr(method))
+            report[name] = self.summarize(values)
+        return report
+
+    def summarize(self, values):
+        return dict(values)
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.stats = {}
+        finally:
+            self.lock.release()
+
+class AllocationTracker(_Tracker):
+    """
+    Records, per method, the memory allocated while dispatching calls to it
+    (parsing the request, the view, and building the response), and how
+    often a garbage collection happened during such a call.
+
+    The numbers are taken from ``gc.get_count()``: ``objects`` is the number
+    of container objects allocated but not freed again, which is what drives
+    the collector. If ``tracemalloc`` is available and tracing, ``bytes``
+    holds the growth of traced memory as well. As these counters are global
+    to the process, calls running in other threads at the same time are
+    included; the numbers are meant to be compared between methods over
+    many calls, not to be exact.
+
+    A collection is detected by the counter of the youngest generation going
+    down; a full collection by the counter of the oldest generation going
+    down. Short calls can miss a collection, so these are lower bounds.
+
+    For each method, the report contains ``calls``, ``seconds`` (total wall
+    time), ``collections`` and ``full_collections`` (calls that overlapped
+    one), as well as ``objects`` and ``bytes``, averaged per call.
+    """
+    def _traced(self):
+        if tracemalloc and tracemalloc.is_tracing():
+            return tracemalloc.get_traced_memory()[0]
+        return None
+
+    def new_stats(self):
+        return {'calls': 0, 'seconds': 0.0, 'objects': 0, 'bytes': 0,
+                'measured': 0, 'collections': 0, 'full_collections': 0}
+
+    def start(self):
+        return time.time(), gc.get_count(), self._traced()
+
+    def stop(self, method, started):
+        start_time, before, traced = started
+        after, seconds = gc.get_count(), time.time() - start_time
+        if traced is not None:
+            traced = self._traced() - traced
+        def update(stats):
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            if after[0] < before[0]:
+                stats['collections'] += 1
+            else:
+                # if the collector ran, we can't know what was allocated
+                stats['measured'] += 1
+                stats['objects'] += after[0] - before[0]
+                if traced is not None:
+                    stats['bytes'] += traced
+            if after[2] < before[2]:
+                stats['full_collections'] += 1
+        self.record(method, update)
+
+    def summarize(self, values):
+        measured = values['measured'] or 1
+        return {
+            'calls': values['calls'],
+            'seconds': values['seconds'],
+            'collections': values['collections'],
+            'full_collections': values['full_collections'],
+            'objects': values['objects'] / float(measured),
+            'bytes': values['bytes'] / float(measured),
+        }
+
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_lists = re.compile(r"\(\?(?:, \?)*\)")
+
+def fingerprint(sql):
+    """
+    Returns ``sql`` with all literal values replaced, so that queries that
+    only differ in their parameters look the same.
+    """
+    return _lists.sub('(...)', _literals.sub('?', sql))
+
+class QueryTracker(_Tracker):
+    """
+    Records, per method, the database queries run while dispatching calls
+    to it, including those run while the response is built (e.g. by related
+    lookups while a ``QuerySet`` is serialized).
+
+    While a call is tracked, Django's debug cursor is used for all database
+    connections, even if ``DEBUG`` is off. Connections are per thread, so
+    other calls running at the same time are not included.
+
+    Queries that run at least ``threshold`` times within one call, differing
+    only in their parameters, are reported as probable N+1 patterns: usually
+    a query per item of a list, where a join or ``select_related`` would do.
+
+    For each method, the report contains ``calls``, ``queries`` (averaged
+    per call), ``max_queries`` (in a single call), ``query_seconds`` (total
+    time spent in queries), and ``repeated``, a dict mapping each query
+    flagged as N+1 (with the parameters replaced by ``?``) to the most it
+    was repeated in one call.
+    """
+    def __init__(self, threshold=3):
+        super(QueryTracker, self).__init__()
+        self.threshold = threshold
+
+    def new_stats(self):
+        return {'calls': 0, 'queries': 0, 'max_queries': 0,
+                'query_seconds': 0.0, 'repeated': {}}
+
+    def start(self):
+        from django.db import connections
+        started = []
+        for alias in connections:
+            connection = connections[alias]
+            started.append((connection, connection.use_debug_cursor,
+                            len(connection.queries)))
+            connection.use_debug_cursor = True
+        return started
+
+    def stop(self, method, started):
+        from django.conf import settings
+        queries = []
+        for connection, use_debug_cursor, count in started:
+            queries.extend(connection.queries[count:])
+            connection.use_debug_cursor = use_debug_cursor
+            # Django only keeps the log in debug mode, and clears it with
+            # each request; we don't want it to grow otherwise.
+            if not settings.DEBUG and not use_debug_cursor:
+                del connection.queries[count:]
+
+        seconds, counts = 0.0, {}
+        for query in queries:
+            seconds += float(query['time'])
+            key = fingerprint(query['sql'])
+            counts[key] = counts.get(key, 0) + 1
+        def update(stats):
+            stats['calls'] += 1
+            stats['queries'] += len(queries)
+            stats['max_queries'] = max(stats['max_queries'], len(queries))
+            stats['query_seconds'] += seconds
+            for key, count in counts.items():
+                if count >= self.threshold:
+                    stats['repeated'][key] = \
+                        max(stats['repeated'].get(key, 0), count)
+        self.record(method, update)
+
+    def summarize(self, values):
+        return {
+            'calls': values['calls'],
+            'queries': values['queries'] / float(values['calls']),
+            'max_queries': values['max_queries'],
+            'query_seconds': values['query_seconds'],
+            'repeated': dict(values['repeated']),
+        }
+
+class CombinedTracker(object):
+    """
+    Uses several trackers at once:
+
+    dispatcher.diagnostics = CombinedTracker(
+        AllocationTracker(), QueryTracker())
+
+    The report contains the numbers of all of them for each method.
+    """
+    def __init__(self, *trackers):
+        self.trackers = trackers
+
+    def start(self):
+        return [tracker.start() for tracker in self.trackers]
+
+    def stop(self, method, started):
+        # in reverse, so that each tracker measures as little of the others
+        # as possible
+        for tracker, state in reversed(zip(self.trackers, started)):
+            tracker.stop(method, state)
+
+    def report(self, api):
+        report = {}
+        for tracker in self.trackers:
+            for name, values in tracker.report(api).items():
+                report.setdefault(name, {}).update(values)
+        return report
+
+    def reset(self):
+        for tracker in self.trackers:
+            tracker.reset()
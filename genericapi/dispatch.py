@@ -1,10 +1,13 @@
-import re
+import re, types, threading
+from urllib import quote
 from django.utils import simplejson
-from core import Dispatcher, BadRequestError
+from core import Dispatcher, APIResponse, BadRequestError, LazyArgument
+import core
 from response import *
 
 __all__ = (
-    'SimpleDispatcher', 'JsonDispatcher', 'RestDispatcher',
+    'SimpleDispatcher', 'JsonDispatcher', 'RestDispatcher', 'NdjsonPayload',
+    'MultiDispatcher', 'Router',
 )
 
 class SimpleDispatcher(Dispatcher):
@@ -16,11 +19,10 @@ class SimpleDispatcher(Dispatcher):
     Uses the free ``url`` argument of ``parse_request`` to pass along the
     method name and arguments, as the ``Dispatcher`` base class is not really
     designed for this kind of use, and doesn't provide a really good way to
-    handle any other incoming data besides the request. The best alternative
-    would probably be attaching custom attributes to ``request``, but it could
-    possibly be ``None`` as well.
+    handle any other incoming data besides the request. The alternative would
+    be attaching custom attributes to the ``CallContext``.
     """
-    def parse_request(self, request, data):
+    def parse_request(self, context, data):
         return (data['name'].split('.'), data['args'], data['kwargs'])
 
     def dispatch(self, name, request=None, *args, **kwargs):
@@ -37,6 +39,42 @@ class BadJsonError(BadRequestError):
         if self.value:
             self.message = 'Invalid JSON (%s)'%self.value
 
+def _loads(value):
+    try: return simplejson.loads(value)
+    except ValueError, e: raise BadJsonError(value)
+
+class Router(object):
+    """
+    Maps url paths ("comments/add") directly to the exposed methods of an
+    API, so that urls can be matched with a dictionary lookup instead of
+    splitting them up and resolving each part. Built from all exposed
+    methods (see ``GenericAPI.prepare``) on first use, and rebuilt when the
+    API is modified.
+    """
+    def __init__(self, api):
+        self.version = core._get_version(api)
+        self.routes = {}
+        for path in api.prepare():
+            self.routes['/'.join(path)] = api.resolve(path)
+
+    @classmethod
+    def get(cls, api):
+        router = _routers.get(api)
+        if router is None or router.version != core._get_version(api):
+            # build it only once, rather than in every thread that got here
+            _routers_lock.acquire()
+            try:
+                router = _routers.get(api)
+                if router is None or \
+                   router.version != core._get_version(api):
+                    router = _routers[api] = cls(api)
+            finally:
+                _routers_lock.release()
+        return router
+
+_routers = {}
+_routers_lock = threading.Lock()
+
 class JsonDispatcher(Dispatcher):
     """
     Reads the method name from the URL, using '/' as a namespace separator.
@@ -61,96 +99,171 @@ class JsonDispatcher(Dispatcher):
     ``jsonp_callback`` contains the name of the parameter that can be used to
     specify a callback function: It will not be a part of the method arguments.
     If not set then callbacks will be disabled. Defaults to 'jsonp'.
+
+    ``fields_name`` is the parameter used to request only some fields of the
+    result, as a comma-separated list (``?fields=id,name``). Like the jsonp
+    callback, it is not passed to the method; instead the result is reduced
+    to these fields (see ``JsonResponse.project``). Defaults to 'fields',
+    ``None`` disables it.
+
+    Views may return a generator, the items of which are then streamed as
+    they are produced (see ``StreamResponse``): as Server-Sent Events if the
+    client accepts ``text/event-stream``, or as newline-delimited JSON
+    otherwise. ``stream_heartbeat`` sets the heartbeat interval in seconds.
+
+    Querystring arguments are only decoded once the method has been resolved
+    and the API key validated. Methods can choose to decode some of them
+    themselves, see ``lazy_arguments``.
     """
     default_response_class = JsonResponse
     # TODO: allow simple strings option
     # TODO: allow GET params option
 
     ident_regex = re.compile('^[_a-zA-Z][_a-zA-Z0-9]*$')
-    
+
     def __init__(self, *args, **kwargs):
         self.jquery_compat = kwargs.pop('jquery_compat', False)
         self.jsonp_name = kwargs.pop('jsonp_callback', 'jsonp')
+        self.fields_name = kwargs.pop('fields_name', 'fields')
+        self.stream_heartbeat = kwargs.pop('stream_heartbeat', None)
         super(JsonDispatcher, self).__init__(*args, **kwargs)
     
-    def make_response(self, request, response_class, *args, **kwargs):
+    def create_context(self, request, url=None):
+        context = super(JsonDispatcher, self).create_context(request, url)
+        context.jsonp_callback = False
+        context.fields = None
+        return context
+
+    def make_response(self, context, response_class, data, *args, **kwargs):
+        # stream generators returned by views
+        items = isinstance(data, APIResponse) and data.data or data
+        if response_class is JsonResponse and \
+           isinstance(items, types.GeneratorType):
+            request = context.request
+            accept = request and request.META.get('HTTP_ACCEPT') or ''
+            response_class = StreamResponse
+            kwargs = kwargs.copy()
+            kwargs['heartbeat'] = self.stream_heartbeat
+            kwargs['process_error'] = \
+                lambda error: self.process_error(context, error)
+            kwargs['stream_format'] = \
+                'text/event-stream' in accept and 'sse' or 'ndjson'
         # if used with a JsonResponse, pass along the jsonp callback value
-        if response_class is JsonResponse:
+        elif response_class is JsonResponse:
             kwargs = kwargs.copy()
-            kwargs['jsonp_callback'] = getattr(request, '_jsonp_callback', False)
+            kwargs['jsonp_callback'] = context.jsonp_callback
+            kwargs['fields'] = context.fields
         return super(JsonDispatcher, self).make_response(
-            request, response_class, *args, **kwargs)
+            context, response_class, data, *args, **kwargs)
 
-    def __parse(self, request, kwargs, path, arg=None):
+    def coalesce_key(self, context, method, args, kwargs):
+        # calls with different jsonp callbacks or fields result in different
+        # responses
+        key = super(JsonDispatcher, self).coalesce_key(
+            context, method, args, kwargs)
+        return key and (key, context.jsonp_callback, context.fields)
+
+    def warm(self):
+        paths = super(JsonDispatcher, self).warm()
+        Router.get(self.api)
+        return paths
+
+    def path_suffix(self, context):
         """
-        Helper function that tries to JSON-parse the value in ``arg`` and
-        then returns everything as a call-tuple. This utility function is
-        used by ``parse_request`` and required because it's not always clear
-        if the last part of an URL is a method name or a positional argument,
-        so we often have to return multiple call-tuples.
+        Returns a string that is appended to the method path of every call,
+        starting with a '/'. Used by ``RestDispatcher``.
         """
-        if arg:
-            try: args = [simplejson.loads(arg)]
-            except ValueError, e: raise BadJsonError(arg)
-        else:
-            args = []
+        return ''
 
-        return [(path, args, kwargs,)]
+    def mount_point(self, context):
+        """
+        Returns the part of the request path before the url the dispatcher
+        resolves, i.e. where it is hooked into the urlconf, or ``None``.
+        """
+        path = context.request and context.request.path or ''
+        url = context.url or ''
+        if not path.endswith(url):
+            return None
+        return path[:len(path) - len(url)].rstrip('/')
 
-    def parse_request(self, request, url):
+    def job_location(self, context, job):
+        base = self.mount_point(context)
+        return base is not None and \
+               '%s/jobs/get/%s' % (base, quote('"%s"' % job.id)) or None
+
+    def parse_request(self, context, url):
         """
         Although we not have to we always return a list (of call-data
         tuples) - even if there is only one option. This makes it easier for
         the ``RestDispatcher`` class that uses us as a base.
+
+        The url is matched against the ``Router`` of the API, and the methods
+        found are returned already resolved.
         """
-        # We may return multiple call tuples, but the query string / kwargs
-        # part is always the same, so for performance reasons why parse those
-        # only once time up front (instead of in ``__parse``.
-        querystrings = dict(request.GET.items())
+        querystrings = dict(context.request.GET.items())
         # Start by handling some special arguments first. In the case of
         # ``jsonp``, the fact that this is pretty much the first thing we do
         # also means that if an error occurs during argument parsing,
         # jsonp-mode will already be active, and the error result will be
         # delivered as jsonp, too.
-        # Assigning to ``request`` is kind of a hack, but currently pretty much
-        # the only way to pass that value along until response-building.
         if self.jsonp_name:
-            request._jsonp_callback = querystrings.pop(self.jsonp_name, False)
+            context.jsonp_callback = querystrings.pop(self.jsonp_name, False)
+        if self.fields_name and self.fields_name in querystrings:
+            context.fields = tuple(filter(None, [f.strip() for f in
+                querystrings.pop(self.fields_name).split(',')]))
         if self.jquery_compat: querystrings.pop('_', None)
-        # convert json query strings into kwargs array
+        # convert json query strings into kwargs array; the values are
+        # only decoded once the call is known to be valid.
         kwargs = {}
         for key, value in querystrings.items():
-            try: kwargs[str(key)] = simplejson.loads(value)
-            except ValueError, e: raise BadJsonError(value)
-        
-        # split the path and remove empty items
-        path = filter(None, url.split('/'))
-        if path:
-            # Unless their are at least two items in path, there can not be any
-            # arguments at all.
-            if len(path) < 2:
-                return self.__parse(request, kwargs, path, '')
-            # If the last item is not an identifier, it must either be the
-            # argument portion, or an invalid call. We just assume the former.
-            # Note that there is no danger for the wrong function being
-            # accidently called because of this, as the previous identier in
-            # the path would have to be a namespace, and the call would fail
-            # anyway (albeit due to a different reason).
-            #
-            #   /namespace/call,  (=> accidental ",", considered an argument)
-            #   => error would be"namespace cannot be called" instead of
-            #      "namespace.call does not exist".
-            elif not self.ident_regex.match(path[-1]):
-                return self.__parse(request, kwargs, path[:-1], path[-1])
-            # Otherwise, we can't say for sure if the last part is an attribute
-            # or not, so we try to return both options. This is ok for the same
-            # reasons outlined above: it cannot lead to the wrong call.
-            else:
-                # if an error is raised at this point for the argument option,
-                # then we already know it can't work out, and leave it off.
-                try: option1 = self.__parse(request, kwargs, path[:-1], path[-1])
-                except BadRequestError: option1 = None
-                return (option1 or []) + self.__parse(request, kwargs, path[:])
+            kwargs[str(key)] = LazyArgument(value, _loads)
+
+        # remove empty items from the path
+        url = url.strip('/')
+        if '//' in url:
+            url = '/'.join(filter(None, url.split('/')))
+        suffix = self.path_suffix(context)
+        routes = Router.get(self.api).routes
+        def option(path, args):
+            # urls not in the route table are left to the regular resolving,
+            # which fails with a proper error message, or finds the method
+            # in a ``LazyNamespace`` not loaded yet.
+            path += suffix
+            return (routes.get(path) or path.split('/'), args, kwargs)
+
+        head, sep, arg = url.rpartition('/')
+        # Unless there are at least two items in the path, there can not be
+        # any arguments at all.
+        if not head:
+            return [option(url, [])]
+        # Calls to known methods are usually settled by the route table
+        # alone: Either the whole url is a method, or all but the last item,
+        # which then is the argument. Everything else, including urls that
+        # could be both, takes the long way below.
+        method = routes.get(url + suffix)
+        head_method = routes.get(head + suffix)
+        if method is not None and head_method is None:
+            return [(method, [], kwargs)]
+        if head_method is not None and method is None:
+            try: return [(head_method, [_loads(arg)], kwargs)]
+            except BadRequestError: pass
+        # If the last item is not an identifier, it must either be the
+        # argument portion, or an invalid call. We just assume the former.
+        # Note that there is no danger for the wrong function being
+        # accidently called because of this, as the previous identier in
+        # the path would have to be a namespace, and the call would fail
+        # anyway (albeit due to a different reason).
+        if not self.ident_regex.match(arg):
+            return [option(head, [_loads(arg)])]
+        # Otherwise, we can't say for sure if the last part is an attribute
+        # or not, so we try to return both options. This is ok for the same
+        # reasons outlined above: it cannot lead to the wrong call. If the
+        # argument is invalid json, we already know that option can't work
+        # out, and leave it off.
+        try: options = [option(head, [_loads(arg)])]
+        except BadRequestError: options = []
+        options.append(option(url, []))
+        return options
 
 class RestDispatcher(JsonDispatcher):
     """
@@ -182,18 +295,161 @@ class RestDispatcher(JsonDispatcher):
     conjunction with other formats, you can create a separate child class for
     the rest dispatcher that implements the rest http methods as wrappers. That
     way, neither format will provide access the each others version of the API.
+
+    Bodies sent as ``application/x-ndjson`` are streamed to the view as an
+    iterator over the decoded records (see ``NdjsonPayload``):
+
+    POST /events/
+    {"type": "click"}
+    {"type": "view"}
+    ==> api.events.post(payload=<iterator>)
     """
     # TODO: support different payload parsers (xml, json, ...)
 
-    def parse_request(self, request, url):
-        options = super(RestDispatcher, self).parse_request(request, url)
-        new_options = []
-        for path, args, kwargs in options:
-            # append http method to path
-            path.append(request.method.lower())
-            #  add post as payload
-            if request.POST:
-                kwargs['payload'] = request.POST
-                
-            new_options.append((path, args, kwargs,))
-        return new_options
\ No newline at end of file
+    def __init__(self, *args, **kwargs):
+        self.max_record_size = kwargs.pop('max_record_size', 1024*1024)
+        super(RestDispatcher, self).__init__(*args, **kwargs)
+
+    def get_payload(self, request):
+        """
+        Returns the payload to pass to the view, if any. Newline-delimited
+        JSON bodies (``application/x-ndjson``) are passed as an
+        ``NdjsonPayload``, which reads the body as the view iterates over it,
+        so uploads of any size can be handled with bounded memory.
+        """
+        content_type = request.META.get('CONTENT_TYPE', '').split(';')[0]
+        if content_type.strip() == 'application/x-ndjson':
+            return NdjsonPayload(request, self.max_record_size)
+        return request.POST
+
+    def path_suffix(self, context):
+        # append http method to path
+        return '/' + context.request.method.lower()
+
+    def job_location(self, context, job):
+        # GET /jobs/<id> ==> api.jobs.get(<id>)
+        base = self.mount_point(context)
+        return base is not None and \
+               '%s/jobs/%s' % (base, quote('"%s"' % job.id)) or None
+
+    def parse_request(self, context, url):
+        options = super(RestDispatcher, self).parse_request(context, url)
+        #  add post as payload
+        payload = self.get_payload(context.request)
+        if payload:
+            for path, args, kwargs in options:
+                kwargs['payload'] = payload
+        return options
+
+class NdjsonPayload(object):
+    """
+    Iterates over the records of a newline-delimited JSON request body. Only
+    one line at a time is read from the request and decoded, when the next
+    record is requested. Lines longer than ``max_record_size`` bytes are
+    rejected with a ``BadRequestError``, invalid JSON with a
+    ``BadJsonError``. Empty lines are skipped.
+
+    As the body is read from the request directly, it can only be iterated
+    over once.
+    """
+    def __init__(self, request, max_record_size):
+        self.request, self.max_record_size = request, max_record_size
+
+    def __iter__(self):
+        while True:
+            line = self.request.readline(self.max_record_size + 1)
+            if not line:
+                return
+            if len(line) > self.max_record_size and not line.endswith('\n'):
+                raise BadRequestError('Record exceeds %d bytes' %
+                                      self.max_record_size)
+            line = line.strip()
+            if line:
+                yield _loads(line)
+
+class MultiDispatcher(Dispatcher):
+    """
+    Serves an API in multiple formats from a single urlconf entry, by
+    delegating to the dispatcher for the format requested:
+
+    urlpatterns = patterns('',
+        (r'^api/(.*)$',  MultiDispatcher(MyAPI, {
+            'json': JsonDispatcher,
+            'rest': RestDispatcher,
+        }, content_types={'application/x-ndjson': 'rest'}, default='json')),
+    )
+
+    GET /api/json/comments/add/"great post"
+    GET /api/rest/comments/1
+
+    The format is taken from the first part of the url, if it names one of
+    the dispatchers. Otherwise, the request's Content-Type is looked up in
+    ``content_types``, and finally ``default`` is used.
+
+    The format dispatchers can be passed as classes, which are created for
+    ``api``, or as instances. Besides the method lookups and call plans of
+    the API, which are always shared, all of them use the same state of
+    their own (e.g. for request coalescing), so that adding another format
+    doesn't cost another set of caches.
+    """
+    def __init__(self, api, dispatchers, content_types=None, default=None):
+        if not dispatchers:
+            # unknown formats are answered in the format of one of them
+            raise ValueError('at least one dispatcher is required')
+        super(MultiDispatcher, self).__init__(api, response_class=False)
+        self.dispatchers = {}
+        for name, dispatcher in dispatchers.items():
+            if isinstance(dispatcher, type):
+                dispatcher = dispatcher(api)
+            self.share_state(dispatcher)
+            self.dispatchers[name] = dispatcher
+        self.content_types = content_types or {}
+        self.default = default
+
+    def warm(self):
+        paths = list(super(MultiDispatcher, self).warm())
+        seen = set(paths)
+        for dispatcher in self.dispatchers.values():
+            for path in dispatcher.warm():
+                if not path in seen:
+                    seen.add(path)
+                    paths.append(path)
+        return paths
+
+    def share_state(self, dispatcher):
+        """
+        Makes ``dispatcher`` use the state of this instance.
+        """
+        dispatcher.coalescer = self.coalescer
+        dispatcher.diagnostics = self.diagnostics
+
+    def _set_diagnostics(self, diagnostics):
+        self._diagnostics = diagnostics
+        for dispatcher in getattr(self, 'dispatchers', {}).values():
+            dispatcher.diagnostics = diagnostics
+    diagnostics = property(lambda self: self._diagnostics, _set_diagnostics)
+
+    def select(self, request, url):
+        """
+        Returns a 2-tuple of the dispatcher to use for the request, and the
+        url it should resolve, or ``(None, url)``.
+        """
+        name, sep, rest = url.lstrip('/').partition('/')
+        if name in self.dispatchers:
+            return self.dispatchers[name], rest
+        content_type = request and request.META.get('CONTENT_TYPE') or ''
+        name = self.content_types.get(content_type.split(';')[0].strip(),
+                                      self.default)
+        return self.dispatchers.get(name), url
+
+    def dispatch(self, request, url=None):
+        url = url or request.path
+        dispatcher, url = self.select(request, url)
+        if dispatcher is None:
+            # respond in the format of any dispatcher we have
+            dispatcher = self.dispatchers.values()[0]
+            context = dispatcher.create_context(request, url)
+            return dispatcher.respond(context,
+                dispatcher.process_error(context,
+                    BadRequestError('Unknown format')))
+        return dispatcher.dispatch(request, url)
@@ -0,0 +1,189 @@
+"""
+Runs calls of long-running methods in the background, see the
+``background`` decorator. The client is answered right away with
+``202 Accepted`` and the location of the job, which it then polls through
+the ``jobs`` namespace that is added to the API:
+
+    jobs.get(id)        the result once the job has finished (or the error
+                        it raised); until then, it's status with code 202.
+    jobs.status(id)     the status: "pending", "running", "done", "failed".
+
+Jobs are only kept in the memory of the process that runs them, so this
+requires requests to be routed back to the same process.
+"""
+
+import sys, time, threading, traceback, binascii, os, heapq, Queue
+from core import Namespace, APIError, APIResponse, BadRequestError, \
+    OverloadedError
+
+__all__ = (
+    'LocalExecutor', 'Job', 'JobStore',
+)
+
+class LocalExecutor(object):
+    """
+    Runs jobs in a pool of ``workers`` threads of the current process. This
+    is the default; any object with a ``submit(func)`` method that makes
+    sure ``func`` is called eventually can be used instead, via the
+    ``job_executor`` option of a ``Meta``.
+    """
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, func):
+        if len(self.threads) < self.workers:
+            self._start()
+        self.queue.put(func)
+
+    def _start(self):
+        # threads are only started when needed
+        self.lock.acquire()
+        try:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            self.lock.release()
+
+    def _work(self):
+        from django.db import connections
+        while True:
+            func = self.queue.get()
+            try:
+                try:
+                    func()
+                except Exception:
+                    self.handle_error(func, sys.exc_info())
+            finally:
+                # like Django does at the end of a request
+                for connection in connections.all():
+                    connection.close()
+
+    def handle_error(self, func, exc_info):
+        """
+        Called with unexpected exceptions raised by a job (``APIError``s are
+        the result of the job, and are not passed here).
+        """
+        traceback.print_exception(*exc_info)
+
+_default_executor = None
+def default_executor():
+    global _default_executor
+    if _default_executor is None:
+        _default_executor = LocalExecutor()
+    return _default_executor
+
+class Job(object):
+    """
+    A call that is run in the background. ``result`` holds what the method
+    returned, or the ``APIError`` it raised, once ``status`` is "done" or
+    "failed".
+    """
+    __slots__ = ('id', 'api', 'status', 'result', 'finished',)
+
+    def __init__(self, api):
+        self.id = binascii.hexlify(os.urandom(16))
+        self.api, self.status = api, 'pending'
+        self.result = self.finished = None
+
+    def run(self, func):
+        self.status = 'running'
+        try:
+            try:
+                self.result = func()
+            except Exception:
+                self.result = APIError()
+                raise
+        finally:
+            self.finished = time.time()
+            self.status = isinstance(self.result, APIError) and 'failed' \
+                          or 'done'
+
+class JobStore(object):
+    """
+    Keeps the jobs of the process, until ``keep`` seconds after they have
+    finished, but no more than ``max_jobs`` of them: When full, the results
+    of the jobs that finished first are dropped early to make room. If
+    all of the jobs are still unfinished, new ones are rejected with an
+    ``OverloadedError``.
+    """
+    def __init__(self, keep=3600, max_jobs=10000):
+        self.keep, self.max_jobs = keep, max_jobs
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.purge_interval = min(keep, 60)
+        self.next_purge = time.time() + self.purge_interval
+
+    def expired(self, job, now):
+        return job.finished and job.finished + self.keep < now
+
+    def purge(self, now):
+        for key, job in self.jobs.items():
+            if self.expired(job, now):
+                del self.jobs[key]
+        self.next_purge = now + self.purge_interval
+
+    def add(self, job):
+        self.lock.acquire()
+        try:
+            now = time.time()
+            if now > self.next_purge or len(self.jobs) >= self.max_jobs:
+                self.purge(now)
+            excess = len(self.jobs) - self.max_jobs + 1
+            if excess > 0:
+                finished = [other for other in self.jobs.values()
+                            if other.finished]
+                if len(finished) < excess:
+                    raise OverloadedError('too many jobs')
+                for other in heapq.nsmallest(excess, finished,
+                                             key=lambda other: other.finished):
+                    del self.jobs[other.id]
+            self.jobs[job.id] = job
+        finally:
+            self.lock.release()
+
+    def get(self, id):
+        now = time.time()
+        if now > self.next_purge:
+            self.lock.acquire()
+            try:
+                self.purge(now)
+            finally:
+                self.lock.release()
+        job = self.jobs.get(id)
+        if job is not None and self.expired(job, now):
+            return None
+        return job
+
+store = JobStore()
+
+def jobs_namespace(api):
+    """
+    Returns the namespace added to APIs that have ``background`` methods.
+    It's methods require an API key just like the rest of the API.
+    """
+    def find(id):
+        job = isinstance(id, basestring) and store.get(id) or None
+        if job is None or not issubclass(job.api, api):
+            raise BadRequestError('unknown job')
+        return job
+
+    class jobs(Namespace):
+        class Meta:
+            expose_by_default = True
+
+        def get(request, id):
+            job = find(id)
+            if job.status in ('pending', 'running'):
+                return APIResponse({'id': job.id, 'status': job.status},
+                                   http_status=202)
+            return job.result
+
+        def status(request, id):
+            return find(id).status
+    return jobs
@@ -0,0 +1,109 @@
+"""
+Self-describing, signed API keys that can be validated without looking them
+up anywhere.
+"""
+
+import time, hmac, hashlib, base64, binascii, os
+
+__all__ = (
+    'SignedKeys',
+)
+
+def _encode(data):
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+def _decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+class SignedKeys(object):
+    """
+    Issues and verifies API keys that carry their own data - an id, the
+    subject they were issued to, an optional expiry time and a list of
+    scopes - signed with ``secret`` (using HMAC-SHA256). Verifying a key
+    only needs the secret, so no database or cache lookup is necessary:
+
+    keys = SignedKeys(settings.SECRET_KEY)
+
+    class MyAPI(GenericAPI):
+        class Meta:
+            check_key = keys.validator()
+
+        @check_key(keys.validator('reports'))
+        def report(request): ...
+
+    Keys can't be changed after they have been issued, so the only way to
+    withdraw a key before it expires is to revoke it: ``revoked`` is a set of
+    key ids, kept in memory. Load it from wherever you store revocations
+    when the process starts, and update it (see ``revoke``) as needed.
+    Changing the secret invalidates all keys.
+    """
+    def __init__(self, secret, revoked=None):
+        from django.utils.encoding import smart_str
+        self.secret = smart_str(secret)
+        self.revoked = set(revoked or ())
+
+    def sign(self, payload):
+        return hmac.new(self.secret, payload, hashlib.sha256).digest()
+
+    def issue(self, subject, scopes=(), lifetime=None):
+        """
+        Returns a new key for ``subject``. If ``lifetime`` (in seconds) is
+        given, the key expires after that time.
+        """
+        from django.utils import simplejson
+        expires = None
+        if lifetime is not None: expires = int(time.time() + lifetime)
+        key_id = binascii.hexlify(os.urandom(8))
+        payload = _encode(simplejson.dumps(
+            [key_id, subject, expires, list(scopes)], separators=(',', ':')))
+        return '%s.%s' % (payload, _encode(self.sign(payload)))
+
+    def verify(self, key):
+        """
+        Returns the data of ``key`` as a dict with ``id``, ``subject``,
+        ``expires`` and ``scopes``, or ``None`` if the key is invalid, has
+        expired or was revoked.
+        """
+        from django.utils import simplejson
+        from django.utils.crypto import constant_time_compare
+        if not isinstance(key, basestring) or key.count('.') != 1:
+            return None
+        try:
+            payload, signature = key.encode('ascii').split('.')
+            signature = _decode(signature)
+        except (UnicodeError, TypeError):
+            # not ASCII, or not base64
+            return None
+        # compare in constant time, so that the timing doesn't tell how
+        # much of a forged signature is correct.
+        if not constant_time_compare(self.sign(payload), signature):
+            return None
+        key_id, subject, expires, scopes = simplejson.loads(_decode(payload))
+        if expires is not None and expires < time.time():
+            return None
+        if key_id in self.revoked:
+            return None
+        return {'id': key_id, 'subject': subject, 'expires': expires,
+                'scopes': scopes}
+
+    def revoke(self, key):
+        """
+        Revokes a key, given as the key itself or it's id.
+        """
+        data = self.verify(key)
+        self.revoked.add(data and data['id'] or key)
+
+    def validator(self, *scopes):
+        """
+        Returns a function to use for ``check_key``, which accepts the keys
+        that are valid and have all of ``scopes``.
+        """
+        def check_key(request, key):
+            data = self.verify(key)
+            if data is None:
+                return False
+            for scope in scopes:
+                if not scope in data['scopes']:
+                    return False
+            return True
+        return check_key
@@ -0,0 +1,57 @@
+import time, threading
+
+__all__ = (
+    'Bulkhead',
+)
+
+class Bulkhead(object):
+    """
+    Limits the number of calls in progress at the same time to ``limit``.
+    Up to ``queue`` further callers wait for a call to finish; everybody
+    beyond that is turned away immediately, rather than tying up yet
+    another thread.
+    """
+    def __init__(self, limit, queue=0):
+        self.limit, self.queue = limit, queue
+        self.active = self.waiting = 0
+        self.condition = threading.Condition(threading.Lock())
+
+    def acquire(self, timeout=None):
+        """
+        Returns ``True`` if the caller may proceed, in which case it has to
+        call ``release`` when done. Returns ``False`` if the queue is full,
+        or if no call finished within ``timeout`` seconds.
+        """
+        self.condition.acquire()
+        try:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            if self.waiting >= self.queue:
+                return False
+            self.waiting += 1
+            try:
+                if timeout is not None:
+                    end = time.time() + timeout
+                while self.active >= self.limit:
+                    if timeout is None:
+                        self.condition.wait()
+                    else:
+                        remaining = end - time.time()
+                        if remaining <= 0:
+                            return False
+                        self.condition.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+        finally:
+            self.condition.release()
+
+    def release(self):
+        self.condition.acquire()
+        try:
+            self.active -= 1
+            self.condition.notify()
+        finally:
+            self.condition.release()
@@ -0,0 +1,293 @@
+"""
+Load generation harness: Drives the dispatchers with many concurrent
+threads through a minimal in-process WSGI stack, against a synthetic API,
+and reports throughput and latency percentiles. Unlike micro-benchmarks,
+this shows the effects of lock contention and garbage collection under
+concurrency, without needing a server.
+
+    python -m genericapi.loadtest --threads 16 --requests 2000
+
+The request mix is generated from a seed up front, so runs with the same
+options perform exactly the same calls.
+"""
+
+import sys, time, random, threading
+from StringIO import StringIO
+from urllib import quote
+from core import GenericAPI, Namespace, BadRequestError, check_key
+
+__all__ = (
+    'SyntheticAPI', 'make_environ', 'wsgi_app', 'run', 'main',
+)
+
+KEYS = ('key-1', 'key-2', 'key-3')
+
+class SyntheticAPI(GenericAPI):
+    """
+    Exercises the features that cost time in real APIs: key validation,
+    ``process_call`` hooks, deep namespaces and jsonp.
+    """
+    class Meta:
+        expose_by_default = True
+        def check_key(request, key): return key in KEYS
+
+    def echo(request, value): return value
+    def add(request, a, b): return a + b
+
+    @check_key(False)
+    def ping(request): return True
+
+    class reports(Namespace):
+        class Meta:
+            def process_call(request, method, args, kwargs):
+                if kwargs.pop('token', None) != 'secret':
+                    raise BadRequestError('invalid token')
+        def summary(request, days=7):
+            return dict([('day%d' % i, i * 1.5) for i in range(days)])
+
+        class detail(Namespace):
+            class by_user(Namespace):
+                def list(request, user, limit=20):
+                    return [{'user': user, 'n': i} for i in range(limit)]
+
+    class items(Namespace):
+        def get(request, id): return {'id': id, 'name': 'item %d' % id}
+        def post(request, payload): return len(payload)
+        def delete(request, id): return None
+
+def make_environ(path, query='', method='GET', body='', headers=None):
+    """
+    Returns a WSGI environ dict for a request.
+    """
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': StringIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    if body:
+        environ['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+    for name, value in (headers or {}).items():
+        environ['HTTP_' + name.upper().replace('-', '_')] = value
+    return environ
+
+def wsgi_app(dispatcher):
+    """
+    Returns a WSGI application that passes every request to ``dispatcher``,
+    which is what the urlconf would do for a single dispatcher entry.
+    """
+    from django.core.handlers.wsgi import WSGIRequest, STATUS_CODE_TEXT
+    def application(environ, start_response):
+        request = WSGIRequest(environ)
+        response = dispatcher(request, environ['PATH_INFO'])
+        status = '%d %s' % (response.status_code,
+                            STATUS_CODE_TEXT.get(response.status_code, ''))
+        start_response(status, [(str(k), str(v)) for k, v in response.items()])
+        return response
+    return application
+
+def _serve(application, environ):
+    """
+    Does what a WSGI server does with a request, minus the socket: calls the
+    application and consumes the response. Returns the status code.
+    """
+    status = []
+    def start_response(status_line, headers):
+        status.append(int(status_line.split(' ', 1)[0]))
+    result = application(environ, start_response)
+    try:
+        for chunk in result:
+            pass
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return status[0]
+
+def _json_calls(rnd):
+    """
+    Yields (path, query, method, body, headers) for ``JsonDispatcher``.
+    """
+    while True:
+        key = '"%s"' % rnd.choice(KEYS)
+        choice = rnd.random()
+        if choice < 0.3:
+            yield ('/echo/%d' % rnd.randint(0, 1000),
+                   'apikey=' + quote(key), 'GET', '', None)
+        elif choice < 0.5:
+            yield ('/add/', 'a=%d&b=%d&apikey=%s' % (
+                rnd.randint(0, 99), rnd.randint(0, 99), quote(key)),
+                   'GET', '', None)
+        elif choice < 0.6:
+            yield ('/ping', 'jsonp=cb%d' % rnd.randint(0, 9), 'GET', '', None)
+        elif choice < 0.75:
+            yield ('/reports/summary/', 'token=%s&days=%d&apikey=%s' % (
+                quote('"secret"'), rnd.randint(1, 30), quote(key)), 'GET',
+                   '', None)
+        elif choice < 0.9:
+            yield ('/reports/detail/by_user/list/"bob"',
+                   'token=%s&limit=%d&jsonp=cb&apikey=%s' % (
+                       quote('"secret"'), rnd.randint(1, 50), quote(key)),
+                   'GET', '', {'Accept': 'application/json'})
+        elif choice < 0.95:
+            # rejected: invalid key
+            yield ('/echo/1', 'apikey=%s' % quote('"wrong"'), 'GET', '', None)
+        else:
+            # rejected: unknown method
+            yield ('/no/such/method%d' % rnd.randint(0, 10000), '', 'GET',
+                   '', None)
+
+def _rest_calls(rnd):
+    while True:
+        query = 'apikey=' + quote('"%s"' % rnd.choice(KEYS))
+        choice = rnd.random()
+        if choice < 0.6:
+            yield ('/items/%d' % rnd.randint(1, 1000), query, 'GET', '', None)
+        elif choice < 0.8:
+            yield ('/items/', query, 'POST',
+                   'name=x&value=%d' % rnd.randint(0, 9), None)
+        else:
+            yield ('/items/%d' % rnd.randint(1, 1000), query, 'DELETE', '',
+                   None)
+
+def _execute_calls(rnd):
+    while True:
+        choice = rnd.random()
+        if choice < 0.5:
+            yield ('echo', (rnd.randint(0, 1000),),
+                   {'apikey': rnd.choice(KEYS)})
+        elif choice < 0.8:
+            yield ('reports.summary', (), {'apikey': rnd.choice(KEYS),
+                                           'token': 'secret'})
+        else:
+            yield ('reports.detail.by_user.list', ('bob',),
+                   {'apikey': rnd.choice(KEYS), 'token': 'secret',
+                    'limit': rnd.randint(1, 50)})
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+def _targets(api):
+    from dispatch import JsonDispatcher, RestDispatcher
+    from response import JsonResponse
+    json_app = wsgi_app(JsonDispatcher(api))
+    rest_app = wsgi_app(RestDispatcher(api))
+    def json_call(call):
+        path, query, method, body, headers = call
+        return _serve(json_app, make_environ(path, query, method, body, headers))
+    def rest_call(call):
+        path, query, method, body, headers = call
+        return _serve(rest_app, make_environ(path, query, method, body, headers))
+    def execute_call(call):
+        name, args, kwargs = call
+        return api.execute(name, response_class=JsonResponse,
+                           *args, **kwargs).status_code
+    return {
+        'json': (_json_calls, json_call),
+        'rest': (_rest_calls, rest_call),
+        'execute': (_execute_calls, execute_call),
+    }
+
+def run(targets=('json', 'rest', 'execute'), threads=8, requests=500,
+        seed=0, api=SyntheticAPI):
+    """
+    Runs ``requests`` calls in each of ``threads`` threads against each of
+    the ``targets`` in turn, and returns a dict mapping each target to it's
+    results: ``requests``, ``seconds``, ``throughput`` (requests/second),
+    ``latency`` (a dict of percentiles in milliseconds), and ``status`` (a
+    dict counting the status codes).
+    """
+    available = _targets(api)
+    results = {}
+    for target in targets:
+        generate, call = available[target]
+        # build the calls up front, so that generating them isn't measured,
+        # and the same seed always results in the same calls.
+        plans = []
+        for index in range(threads):
+            calls = generate(random.Random(
+                (seed * 1000 + sorted(available).index(target)) * 1000 + index))
+            plans.append([calls.next() for i in range(requests)])
+
+        latencies, statuses, errors = [], {}, []
+        lock, start = threading.Lock(), threading.Event()
+        def worker(plan):
+            timings, codes = [], {}
+            start.wait()
+            try:
+                for item in plan:
+                    begin = time.time()
+                    status = call(item)
+                    timings.append(time.time() - begin)
+                    codes[status] = codes.get(status, 0) + 1
+            except Exception, e:
+                errors.append(e)
+            lock.acquire()
+            try:
+                latencies.extend(timings)
+                for status, count in codes.items():
+                    statuses[status] = statuses.get(status, 0) + count
+            finally:
+                lock.release()
+
+        workers = [threading.Thread(target=worker, args=(plan,))
+                   for plan in plans]
+        for thread in workers: thread.start()
+        begin = time.time()
+        start.set()
+        for thread in workers: thread.join()
+        seconds = time.time() - begin
+        if errors:
+            raise errors[0]
+
+        latencies.sort()
+        results[target] = {
+            'requests': len(latencies),
+            'seconds': seconds,
+            'throughput': seconds and len(latencies) / seconds or None,
+            'latency': dict([(p, _percentile(latencies, p) * 1000)
+                             for p in (50, 90, 99, 100)]),
+            'status': statuses,
+        }
+    return results
+
+def main(argv=None):
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options] [json|rest|execute ...]')
+    parser.add_option('-t', '--threads', type='int', default=8)
+    parser.add_option('-n', '--requests', type='int', default=500,
+                      help='requests per thread and target')
+    parser.add_option('-s', '--seed', type='int', default=0)
+    options, targets = parser.parse_args(argv)
+
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure()
+
+    results = run(targets or ('json', 'rest', 'execute'),
+                  options.threads, options.requests, options.seed)
+    for target, result in sorted(results.items()):
+        print '%-8s %7d requests in %6.2fs  %9.1f req/s' % (
+            target, result['requests'], result['seconds'],
+            result['throughput'] or 0)
+        print '         latency ms: p50 %.2f  p90 %.2f  p99 %.2f  max %.2f' % (
+            result['latency'][50], result['latency'][90],
+            result['latency'][99], result['latency'][100])
+        print '         status: %s' % ', '.join(
+            ['%s=%d' % item for item in sorted(result['status'].items())])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Keyset ("cursor") pagination for methods returning a ``QuerySet``, see the
+``paginate`` decorator.
+
+Rather than skipping rows with OFFSET, which makes the database read (and
+throw away) every row before the requested page, each page continues after
+the ordering key of the last row of the previous one. The key is handed to
+the client as an opaque cursor.
+"""
+
+import base64, operator
+from core import BadRequestError
+
+__all__ = (
+    'Page', 'encode_cursor', 'decode_cursor',
+)
+
+def encode_cursor(values):
+    """
+    Encodes a list of ordering key values into a cursor string.
+    """
+    from django.utils import simplejson
+    from django.core.serializers.json import DjangoJSONEncoder
+    return base64.urlsafe_b64encode(
+        simplejson.dumps(values, cls=DjangoJSONEncoder)).rstrip('=')
+
+def decode_cursor(cursor):
+    """
+    The counterpart of ``encode_cursor``. Raises a ``BadRequestError`` if
+    ``cursor`` is not valid.
+    """
+    from django.utils import simplejson
+    try:
+        cursor = str(cursor)
+        values = simplejson.loads(
+            base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError, UnicodeError):
+        raise BadRequestError('invalid cursor')
+    if not isinstance(values, list):
+        raise BadRequestError('invalid cursor')
+    return values
+
+def _value(instance, name):
+    # the value of an ordering field, which may span relations
+    from django.db.models import Model
+    for part in name.split('__'):
+        instance = getattr(instance, part)
+        if isinstance(instance, Model):
+            instance = instance.pk
+    return instance
+
+class Page(object):
+    """
+    A page of ``queryset`` of at most ``limit`` rows, following the row the
+    ``cursor`` was created from (or the first one).
+
+    The queryset is ordered as it already is (or by the model's default
+    ordering), with the primary key added to make the order unique. The
+    ordering fields should not be nullable. Nothing is fetched until
+    ``fetch`` is called, so the queryset can still be changed.
+    """
+    __slots__ = ('queryset', 'values', 'limit',)
+
+    def __init__(self, queryset, cursor=None, limit=50):
+        self.queryset, self.limit = queryset, limit
+        self.values = cursor is not None and decode_cursor(cursor) or None
+
+    def ordering(self):
+        query = self.queryset.query
+        ordering = list(query.order_by or (query.default_ordering and
+                        self.queryset.model._meta.ordering) or [])
+        names = [field.lstrip('-') for field in ordering]
+        if not 'pk' in names and \
+           not self.queryset.model._meta.pk.name in names:
+            ordering.append('pk')
+        return ordering
+
+    def _after(self, ordering, values):
+        """
+        Returns the filter for rows following ``values``: For an ordering by
+        (a, b), ``a > x OR (a = x AND b > y)``.
+        """
+        from django.db.models import Q
+        if len(values) != len(ordering):
+            raise BadRequestError('invalid cursor')
+        condition = None
+        for index, field in enumerate(ordering):
+            lookup = field.startswith('-') and 'lt' or 'gt'
+            q = reduce(operator.and_,
+                [Q(**{previous.lstrip('-'): value})
+                 for previous, value in zip(ordering[:index], values)] +
+                [Q(**{'%s__%s' % (field.lstrip('-'), lookup): values[index]})])
+            condition = condition is None and q or condition | q
+        return condition
+
+    def fetch(self):
+        """
+        Runs the query. Returns a 2-tuple of the list of objects, and the
+        cursor for the next page, or ``None`` if this is the last one.
+        """
+        ordering = self.ordering()
+        queryset = self.queryset.order_by(*ordering)
+        if self.values is not None:
+            queryset = queryset.filter(self._after(ordering, self.values))
+        # one more row than needed tells us whether there is another page
+        items = list(queryset[:self.limit + 1])
+        if len(items) <= self.limit:
+            return items, None
+        items = items[:self.limit]
+        return items, encode_cursor(
+            [_value(items[-1], field.lstrip('-')) for field in ordering])
@@ -1,14 +1,20 @@
-﻿from core import APIResponse, APIError
+﻿import sys, threading, Queue
+from core import APIResponse, APIError, BadRequestError, InvalidKeyError, \
+    MethodNotFoundError
 
 __all__ = (
-    'PythonResponse', 'JsonResponse',
+    'PythonResponse', 'JsonResponse', 'StreamResponse',
 )
 
+# pre-encoded bodies of messageless errors, see ``JsonResponse.serialize_error``
+_error_bodies = {}
+
 class PythonResponse(APIResponse):
     """
     Special response class that returns the native python objects, as
     retrieved from the user's API views. Exceptions are re-raised.
     """
+    __slots__ = ()
     def get_response(self):
         if isinstance(self.data, Exception):
             raise self.data
@@ -20,33 +26,231 @@ class JsonResponse(APIResponse):
     Partly based on:
         http://www.djangosnippets.org/snippets/154/
     """
+    __slots__ = ('jsonp_callback', 'fields',)
     def __init__(self, *args, **kwargs):
         """
         Supports an additional argument ``jsonp_callback``. If specified, the
         JSON serialized data string will be wrapped in parenthesis and prefixed
         by the value of ``jsonp_callback``.
+
+        ``fields`` can be a list of names to restrict the data to, see
+        ``project``.
         """
         self.jsonp_callback = kwargs.pop('jsonp_callback', None)
+        self.fields = kwargs.pop('fields', None)
         super(JsonResponse, self).__init__(*args, **kwargs)
-        
+        if self.fields and not isinstance(self.data, APIError):
+            self.data = self.project(self.data)
+
+    def project(self, data):
+        """
+        Restricts ``data`` to the keys in ``fields``: A dict, or each dict in
+        a list, is reduced to those keys; other values are left alone.
+
+        A ``QuerySet`` (or ``Page``) is left alone as well, the serializer
+        is given the fields instead. It is not changed to load only those
+        columns, because the serializer would then label the objects with
+        the name of Django's deferred model class. Many-to-many fields can
+        be requested as well, but note that the serializer runs a query per
+        row for each of them.
+        """
+        fields = self.fields
+        if isinstance(data, dict):
+            return dict([(k, data[k]) for k in fields if k in data])
+        elif isinstance(data, (list, tuple)):
+            return [self.project(item) if isinstance(item, dict) else item
+                    for item in data]
+        return data
+
+    @classmethod
+    def prepare(cls):
+        # import what ``format`` needs, and pre-encode the built-in errors
+        from django.db.models.query import QuerySet
+        from django.core import serializers
+        import pagination
+        for error_class in (APIError, BadRequestError, InvalidKeyError,
+                            MethodNotFoundError):
+            cls(None).serialize_error(error_class())
+
     def format(self, data):
+        """
+        Returns the response body. For jsonp, it's a list of chunks, which
+        are passed along to the server as they are: The callback is added as
+        separate chunks around the serialized data, instead of copying the
+        whole body into a new string. Otherwise, the serialized data is
+        returned as a plain string, so that Django doesn't treat the
+        response as an iterator.
+        """
         from django.db.models.query import QuerySet
         from django.utils import simplejson
+        from django.utils.encoding import smart_str
+        from pagination import Page
         if data is None:
             content = ''
         elif isinstance(data, QuerySet):
             from django.core import serializers
-            content = serializers.serialize('json', data)
+            content = serializers.serialize('json', data, fields=self.fields)
+        elif isinstance(data, Page):
+            from django.core import serializers
+            items, next = data.fetch()
+            content = '{"results": %s, "next": %s}' % (
+                serializers.serialize('json', items, fields=self.fields),
+                simplejson.dumps(next))
         elif isinstance(data, APIError):
-            content = simplejson.dumps(data.data)
+            content = self.serialize_error(data)
         else:
             content = simplejson.dumps(data)
         if self.jsonp_callback or self.jsonp_callback == '':
             # note that an empty jsonp name is allowed as well
-            content = u"%s(%s)" % (self.jsonp_callback, content)
+            return [smart_str(self.jsonp_callback) + '(', content, ')']
         return content
     
+    def serialize_error(self, error):
+        """
+        Serializes an error. Errors without a message or custom data always
+        look the same, so their encoded body is only built once per error
+        class (and response class), and then reused. For errors that only
+        add a message (e.g. ``MethodNotFoundError``), the body around the
+        message is built once, and the encoded message spliced in.
+        """
+        from django.utils import simplejson
+        if error._is_static():
+            key = (type(self), type(error))
+            content = _error_bodies.get(key)
+            if content is None:
+                content = _error_bodies[key] = simplejson.dumps(error.data)
+            return content
+        if error._is_default() and isinstance(error.message, basestring):
+            key = (type(self), type(error), 'message')
+            prefix = _error_bodies.get(key)
+            if prefix is None:
+                # '{"error": "Name: ' - without the closing '"}'
+                prefix = _error_bodies[key] = \
+                    simplejson.dumps({'error': error.name + ': '})[:-2]
+            return prefix + simplejson.dumps(error.message)[1:] + '}'
+        return simplejson.dumps(error.data)
+
     def get_response(self, *args, **kwargs):
         response = super(JsonResponse, self).get_response(*args, **kwargs)
         response.mimetype='application/json'
-        return response
\ No newline at end of file
+        return response
+
+class StreamResponse(APIResponse):
+    """
+    Sends the items of an iterable, usually a generator returned by a view,
+    to the client one by one: Each item is serialized to JSON and handed to
+    the server as soon as it is available, either as newline-delimited JSON
+    (``stream_format='ndjson'``, the default), or as Server-Sent Events
+    (``stream_format='sse'``).
+
+    If ``heartbeat`` is given (in seconds), the iterable is consumed in a
+    separate thread, and whenever no item is available for that long, a
+    heartbeat (an empty line, or a comment for SSE) is sent to keep the
+    connection alive. Note that Django's database connections are per
+    thread, so views using this should not share lazy querysets with the
+    generator.
+
+    An ``APIError`` raised during streaming is sent as the last item (for
+    SSE as an ``error`` event), after being passed to ``process_error``, a
+    function the dispatcher gives, so that it is formatted like any other
+    error (see ``Dispatcher.process_error``). Middleware that needs the whole content
+    (e.g. gzip, etags) defeats the purpose of this class.
+    """
+    __slots__ = ('stream_format', 'heartbeat', 'process_error',)
+    mimetypes = {
+        'ndjson': 'application/x-ndjson',
+        'sse': 'text/event-stream',
+    }
+
+    def __init__(self, *args, **kwargs):
+        self.stream_format = kwargs.pop('stream_format', 'ndjson')
+        self.heartbeat = kwargs.pop('heartbeat', None)
+        self.process_error = kwargs.pop('process_error', None)
+        super(StreamResponse, self).__init__(*args, **kwargs)
+
+    def format(self, data):
+        # an error that occured before the stream started
+        if isinstance(data, APIError):
+            return [self.format_item(data)]
+        return self.iter_items(data)
+
+    def format_item(self, item):
+        """
+        Returns the chunk to send for a single item.
+        """
+        from django.utils import simplejson
+        if isinstance(item, APIError):
+            content = simplejson.dumps(item.data)
+            if self.stream_format == 'sse':
+                return 'event: error\ndata: %s\n\n' % content
+        else:
+            content = simplejson.dumps(item)
+        if self.stream_format == 'sse':
+            return 'data: %s\n\n' % content
+        return content + '\n'
+
+    def iter_items(self, items):
+        if self.heartbeat:
+            items = _with_heartbeat(items, self.heartbeat)
+        try:
+            for item in items:
+                if item is _heartbeat:
+                    yield self.stream_format == 'sse' and ':\n\n' or '\n'
+                else:
+                    yield self.format_item(item)
+        except APIError, e:
+            if self.process_error:
+                e = self.process_error(e)
+            yield self.format_item(e)
+
+    def get_response(self, *args, **kwargs):
+        response = super(StreamResponse, self).get_response(*args, **kwargs)
+        response['Content-Type'] = self.mimetypes[self.stream_format]
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+_heartbeat = object()
+
+def _with_heartbeat(items, interval):
+    """
+    Consumes ``items`` in a separate thread, and yields ``_heartbeat``
+    whenever the next item took longer than ``interval`` seconds. At most one
+    item is read ahead. When the consumer goes away (the generator is closed),
+    the thread stops at the next item.
+    """
+    queue, stopped = Queue.Queue(1), threading.Event()
+    def put(value):
+        while not stopped.isSet():
+            try:
+                queue.put(value, timeout=interval)
+                return True
+            except Queue.Full:
+                pass
+        return False
+    def produce():
+        try:
+            for item in items:
+                if not put((True, item)): return
+        except Exception:
+            put((False, sys.exc_info()))
+        else:
+            put((False, None))
+    thread = threading.Thread(target=produce)
+    thread.setDaemon(True)
+    thread.start()
+
+    try:
+        while True:
+            try:
+                is_item, value = queue.get(timeout=interval)
+            except Queue.Empty:
+                yield _heartbeat
+                continue
+            if is_item:
+                yield value
+            elif value:
+                raise value[0], value[1], value[2]
+            else:
+                return
+    finally:
+        stopped.set()
@@ -0,0 +1,17 @@
+"""
+Namespaces loaded by ``test_basic.test_lazy_namespace`` and
+``test_dispatch.test_background_jobs``.
+"""
+
+from genericapi import Namespace, background
+
+class ReportsNamespace(Namespace):
+    class Meta: expose_by_default = True
+    def summary(request, days=7): return days
+    class detail(Namespace):
+        def get(request, id): return id
+
+class ExportsNamespace(Namespace):
+    class Meta: expose_by_default = True
+    @background
+    def build(request): return 'done'
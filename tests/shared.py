@@ -1,6 +1,16 @@
 # setup dummy django environment
 from django.conf import settings
-settings.configure()
+settings.configure(DATABASES={'default': {
+    'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}})
+
+def create_tables(*models):
+    # there is no syncdb for the models defined in the tests
+    from django.db import connection
+    from django.core.management.color import no_style
+    cursor = connection.cursor()
+    for model in models:
+        for sql in connection.creation.sql_create_model(model, no_style())[0]:
+            cursor.execute(sql)
 
 from py.test import raises
 from genericapi import *
\ No newline at end of file
@@ -123,6 +123,19 @@ def test_key_auth():
     # [bug] make sure setting check_key to ``False`` in a Meta disables at
     # declaration time works.
     assert SampleAPI.execute('key.public.test') == True
+
+    # changing the attributes of a method after it has been called works,
+    # even though the options in effect are cached
+    class API(GenericAPI):
+        @expose
+        @check_key(lambda r, key: key == 'k')
+        def m(r): return True
+    assert API.execute('m', apikey='k') == True
+    raises(InvalidKeyError, API.execute, 'm')
+    API.m.check_key = False
+    assert API.execute('m') == True
+    API.m.check_key = lambda r, key: key == 'other'
+    raises(InvalidKeyError, API.execute, 'm', apikey='k')
     
 def test_call_preprocessing():
     """
@@ -142,4 +155,50 @@ def test_call_preprocessing():
     assert SampleAPI.execute('auth.test') == True
     
     # method-specific processors are possible as well
-    assert SampleAPI.execute('auth.for_alice', user='alice') == True
\ No newline at end of file
+    assert SampleAPI.execute('auth.for_alice', user='alice') == True
+
+
+def test_signed_keys():
+    """
+    Test validating keys by their signature.
+    """
+    keys = SignedKeys('secret')
+    key = keys.issue('bob', scopes=['reports'])
+    data = keys.verify(key)
+    assert data['subject'] == 'bob' and data['scopes'] == ['reports']
+    assert data['expires'] is None
+    assert keys.verify(unicode(key)) == data
+    # invalid keys
+    payload, signature = key.split('.')
+    assert keys.verify(payload + '.' + signature[:-2]) is None
+    assert keys.verify(keys.issue('bob')[:-5] + '.' + signature) is None
+    assert keys.verify(payload) is None
+    assert keys.verify(None) is None
+    assert keys.verify('\xff.abc') is None
+    assert keys.verify(u'\xe4.abc') is None
+    assert SignedKeys('other').verify(key) is None
+    # expired keys
+    assert keys.verify(keys.issue('bob', lifetime=60))
+    assert keys.verify(keys.issue('bob', lifetime=-1)) is None
+    # revoked keys
+    other = keys.issue('alice')
+    keys.revoke(key)
+    assert keys.verify(key) is None
+    assert keys.verify(other)
+    keys = SignedKeys('secret', revoked=[data['id']])
+    assert keys.verify(key) is None
+
+    # as key validators, with scopes
+    keys = SignedKeys('secret')
+    class API(GenericAPI):
+        class Meta:
+            expose_by_default = True
+            check_key = keys.validator()
+        def test(r): return True
+        @check_key(keys.validator('reports'))
+        def report(r): return True
+    key = keys.issue('bob', scopes=['reports'])
+    assert API.execute('test', apikey=key) == True
+    assert API.execute('report', apikey=key) == True
+    raises(InvalidKeyError, API.execute, 'test', apikey='zzz')
+    raises(InvalidKeyError, API.execute, 'report', apikey=keys.issue('bob'))
@@ -1,4 +1,5 @@
 from shared import *
+from django.http import QueryDict
 
 # helper functions for testing api calls.
 def can_call(apicls, name, *args, **kwargs):
@@ -30,6 +31,22 @@ def test_class():
     # the ``Meta`` class is not removed, and still accessible as an attribute
     TestAPI.Meta
 
+    # methods hold the decorator attributes themselves, everything else is
+    # taken from the function.
+    class TestAPI(GenericAPI):
+        @expose
+        @check_key(False)
+        def method(r): pass
+        def other(r): pass
+    # custom attributes can still be attached to methods
+    TestAPI.method.custom = True
+    assert TestAPI.method.custom == True
+    assert TestAPI.method.exposed == True
+    assert TestAPI.method.check_key == False
+    assert TestAPI.other.exposed is None
+    assert TestAPI.method.__name__ == 'method'
+    assert TestAPI.method._namespace is TestAPI
+
 def test_accessibility():
     """Make sure we can and cannot access the right functions."""
 
@@ -163,4 +180,119 @@ def test_inheritance():
     cannot_call(ApiB, 'notexposed_a')
     cannot_call(ApiC, 'notexposed_a')
     can_call(ApiC, 'notexposed_b')
-    cannot_call(ApiC, 'notexposed_c')
\ No newline at end of file
+    cannot_call(ApiC, 'notexposed_c')
+
+
+def test_resolve_lookup():
+    """
+    Make sure the shortcuts taken for unknown paths don't get in the way.
+    """
+    from genericapi.core import _lookups
+    class TestAPI(GenericAPI):
+        @expose
+        def root(r): return True
+        class sub(Namespace):
+            def hidden(r): return True
+
+    # paths with unknown names are rejected right away
+    assert TestAPI.resolve(['sub', 'foo']) is None
+    assert not _lookups[TestAPI].misses
+    # other paths that can't be resolved are remembered
+    assert TestAPI.resolve(['sub', 'hidden']) is None
+    assert ('sub', 'hidden') in _lookups[TestAPI].misses
+    assert TestAPI.resolve(['root']) is TestAPI.root
+
+    # changing the API invalidates what we know, including the attributes
+    # of methods
+    TestAPI.sub.hidden.exposed = True
+    assert TestAPI.resolve(['sub', 'hidden']) is TestAPI.sub.hidden
+    from genericapi.dispatch import Router
+    assert 'sub/hidden' in Router.get(TestAPI).routes
+    TestAPI.sub.hidden.exposed = None
+    assert TestAPI.resolve(['sub', 'hidden']) is None
+    assert not 'sub/hidden' in Router.get(TestAPI).routes
+    TestAPI.sub._meta.expose_by_default = True
+    assert TestAPI.resolve(['sub', 'hidden']) is TestAPI.sub.hidden
+    TestAPI.sub.foo = TestAPI.root
+    assert TestAPI.resolve(['sub', 'foo']) is TestAPI.root
+
+    # the number of failed paths remembered is limited
+    lookup = _lookups[TestAPI]
+    lookup.max_misses = 3
+    for a in ('root', 'sub', 'foo'):
+        for b in ('root', 'sub', 'foo'):
+            TestAPI.resolve([a, b])
+    assert 0 < len(lookup.misses) <= 3
+    # as is their length: paths longer than any in the API are rejected
+    assert TestAPI.resolve(['sub'] * 3) is None
+    assert not ('sub',) * 3 in lookup.misses
+
+def test_prepare():
+    """
+    Test building all caches in advance.
+    """
+    class TestAPI(GenericAPI):
+        @expose
+        def root(r): return True
+        def hidden(r): return True
+        class sub(Namespace):
+            class Meta:
+                expose_by_default = True
+                check_key = False
+            def a(r): return True
+            class subsub(Namespace):
+                def b(r): return True
+    class TestAPIEx(TestAPI):
+        class sub(TestAPI.sub):
+            @conceal
+            def a(r): return True
+    assert sorted(TestAPI.prepare()) == [('root',), ('sub', 'a'), ('sub', 'subsub', 'b')]
+    assert TestAPI.sub.a._plan.check_key == False
+    # (resolving backtracks to the exposed ``a`` of the super class)
+    assert sorted(TestAPIEx.prepare()) == sorted(TestAPI.prepare())
+
+    # dispatchers prepare their response class as well
+    from genericapi.response import _error_bodies
+    _error_bodies.clear()
+    assert len(JsonDispatcher(TestAPI).warm()) == 3
+    assert len(_error_bodies) == 4
+
+def test_lazy_namespace():
+    """
+    Test namespaces that are imported on first use.
+    """
+    import sys
+    from django.http import HttpRequest
+    class TestAPI(GenericAPI):
+        class Meta:
+            def check_key(request, key): return key == 'k'
+        @expose
+        def root(r): return True
+        reports = LazyNamespace('tests.lazy_reports.ReportsNamespace')
+    sys.modules.pop('tests.lazy_reports', None)
+    # nothing is loaded until a call is made into the namespace
+    assert TestAPI.prepare() == [('root',)]
+    cannot_call(TestAPI, 'missing', apikey='k')
+    assert not 'tests.lazy_reports' in sys.modules
+    class OtherAPI(GenericAPI):
+        @expose
+        def root(r): return True
+    plan, router = OtherAPI.root.get_plan(), Router.get(OtherAPI)
+
+    # the first call through a dispatcher already works
+    request = HttpRequest()
+    request.path = '/reports/detail/get/5'
+    request.GET = QueryDict('apikey="k"')
+    assert JsonDispatcher(TestAPI, response_class=False)(request) == 5
+    assert 'reports/detail/get' in Router.get(TestAPI).routes
+    # other APIs are not affected by the loading
+    assert OtherAPI.root.get_plan() is plan
+    assert Router.get(OtherAPI) is router
+    ReportsNamespace = sys.modules['tests.lazy_reports'].ReportsNamespace
+    assert TestAPI.reports is ReportsNamespace
+    # it is part of the API like any other namespace: the options of the
+    # parent apply, and it's methods are known
+    assert ReportsNamespace._meta.parent is TestAPI._meta
+    raises(InvalidKeyError, TestAPI.execute, 'reports.summary')
+    can_call(TestAPI, 'reports.summary', 3, apikey='k', expect=3)
+    assert ('reports', 'summary') in TestAPI.prepare()
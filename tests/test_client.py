@@ -0,0 +1,44 @@
+"""
+Test the in-process client.
+"""
+
+from shared import *
+
+class SampleAPI(GenericAPI):
+    class Meta:
+        expose_by_default = True
+        def check_key(request, key): return key == 'abc'
+    def echo(request, value): return value
+    class comments(Namespace):
+        class Meta:
+            check_key = False
+            def process_call(request, method, args, kwargs):
+                args.append(kwargs.pop('extra', 'x'))
+        def add(request, text, extra): return text + extra
+
+def test_client():
+    client = SampleAPI.get_client()
+    # the client is shared
+    assert SampleAPI.get_client() is client
+    assert SampleAPI.get_client(JsonResponse) is not client
+
+    # calls work like with ``execute``
+    assert client.echo(5, apikey='abc') == 5
+    raises(InvalidKeyError, client.echo, 5, apikey='zzz')
+    assert client.comments.add('a', extra='b') == 'ab'
+    assert client.comments.add('a') == 'ax'
+    raises(MethodNotFoundError, client.comments.remove)
+    raises(MethodNotFoundError, client.comments)
+    assert client.comments.add is client.comments.add
+    # python's own special names are not considered method paths
+    raises(AttributeError, getattr, client, '__length_hint__')
+
+    # with a response class
+    assert SampleAPI.get_client(JsonResponse).echo(
+                                    'b', apikey='abc').content == '"b"'
+    assert SampleAPI.get_client(JsonResponse).nothing().status_code == 500
+
+    # changes to the API are picked up
+    SampleAPI.comments._meta.check_key = None
+    raises(InvalidKeyError, client.comments.add, 'a')
+    assert client.comments.add('a', apikey='abc') == 'ax'
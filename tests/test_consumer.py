@@ -0,0 +1,82 @@
+"""
+Test executing calls from a queue.
+"""
+
+import os, tempfile, threading, time, datetime
+from shared import *
+
+class SampleAPI(GenericAPI):
+    class Meta:
+        expose_by_default = True
+        def check_key(request, key): return key == 'k'
+    def add(request, a, b): return a + b
+    def fail(request): raise BadRequestError('no')
+    def today(request): return datetime.date.today()
+    class ns(Namespace):
+        class Meta: check_key = False
+        def echo(request, value=None): return value
+
+def check_queue(queue):
+    ids = [
+        queue.put({'method': 'add', 'args': [1, 2], 'key': 'k'}),
+        queue.put({'method': 'add', 'kwargs': {'a': 1, 'b': 5}, 'key': 'k'}),
+        queue.put({'method': 'add', 'args': [1, 2], 'key': 'wrong'}),
+        queue.put({'method': 'fail', 'key': 'k'}),
+        queue.put({'method': 'ns.echo', 'args': ['x']}),
+        queue.put({'method': 'no.such.method'}),
+        queue.put({'method': 'ns.echo', 'deadline': time.time() - 1}),
+        queue.put({'method': 'today', 'key': 'k'}),
+        queue.put({'method': 'ns.echo', 'args': ['y'], 'key': 'k'}),
+    ]
+    assert queue.get_result(ids[0]) is None
+    dispatcher = QueueDispatcher(SampleAPI, queue, batch_size=3, workers=2)
+    dispatcher.run(timeout=0)
+    results = [queue.get_result(id) for id in ids]
+    assert results[0] == {'result': 3}
+    assert results[1] == {'result': 6}
+    assert results[2]['error'] == {'error': 'Invalid API Key'}
+    assert results[3] == {'error': {'error': 'Bad Request: no'},
+                          'status': 500}
+    assert results[4] == {'result': 'x'}
+    assert results[5]['error'] == \
+        {'error': 'Method Not Found: no.such.method'}
+    assert results[6]['status'] == 504
+    # a result that can't be encoded doesn't lose the rest of the batch
+    assert results[7]['status'] == 500
+    assert 'not serializable' in results[7]['error']['error']
+    # a key given for a method that doesn't check keys is ignored
+    assert results[8] == {'result': 'y'}
+    # everything was consumed
+    assert queue.get_batch(10, timeout=0) == []
+
+def test_memory_queue():
+    check_queue(MemoryQueue())
+
+def test_sqlite_queue():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        check_queue(SqliteQueue(path, poll_interval=0.01))
+        # batches are taken only once
+        queue = SqliteQueue(path)
+        queue.put({'method': 'ns.echo'}); queue.put({'method': 'ns.echo'})
+        assert len(queue.get_batch(1)) == 1
+        assert len(SqliteQueue(path).get_batch(5, timeout=0)) == 1
+        # unless their results aren't written in time
+        assert SqliteQueue(path).get_batch(5, timeout=0) == []
+        assert len(SqliteQueue(path, retry_after=0).get_batch(5)) == 2
+    finally:
+        os.unlink(path)
+
+def test_run_until_stopped():
+    queue, stop = MemoryQueue(), threading.Event()
+    dispatcher = QueueDispatcher(SampleAPI, queue)
+    thread = threading.Thread(target=dispatcher.run, args=(stop, 0.01))
+    thread.start()
+    id = queue.put({'method': 'ns.echo', 'args': [1]})
+    for i in range(1000):
+        if queue.get_result(id): break
+        time.sleep(0.001)
+    stop.set()
+    thread.join()
+    assert queue.get_result(id) == {'result': 1}
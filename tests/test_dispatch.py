@@ -2,9 +2,11 @@ from urlparse import urlparse
 from shared import *
 from genericapi.core import Dispatcher
 from django.http import HttpRequest, QueryDict
+from django.db import models
 
-def make_request(url, method=None, post=None):
+def make_request(url, method=None, post=None, accept=None):
     r = HttpRequest()
+    if accept: r.META['HTTP_ACCEPT'] = accept
     url = urlparse(url)
     r.GET = QueryDict(url[4])  # url.query (2.5)
     r.path = url[2]            # url.path (2.5)
@@ -12,6 +14,13 @@ def make_request(url, method=None, post=None):
     if post: r.POST.update(post)
     return r
 
+class Item(models.Model):
+    name = models.CharField(max_length=10)
+    class Meta:
+        app_label = 'tests'
+        ordering = ('-name',)
+create_tables(Item)
+
 class SampleAPI(GenericAPI):
     class Meta: expose_by_default = True
     def noop(request): return None
@@ -21,6 +30,7 @@ class SampleAPI(GenericAPI):
     def make_list(request, *args): return list(args)
     def make_dict(request, **kwargs): return kwargs
     def echo(request, val): return val
+    def count(request, n): return (i for i in range(n))
     class ns(Namespace):
         def give_me_false(request): return False
         def with_param(request, param): return param
@@ -30,6 +40,13 @@ class SampleAPI(GenericAPI):
             def delete(request, id): return True
             def post(request, payload): return True
             def put(request, id, payload): return True
+        class bulk(Namespace):
+            def post(request, payload): return [r for r in payload]
+    @paginate(2)
+    def pages(request, n=3): return range(n)
+    def items(request): return Item.objects.all()
+    @paginate(2)
+    def item_pages(request): return Item.objects.all()
 
 def test_common():
     """
@@ -130,9 +147,135 @@ def test_json_dispatch():
     # 4) they can be disabled
     dispatcher = JsonDispatcher(SampleAPI, jsonp_callback=False, response_class=False)
     raises(BadRequestError, "dispatcher(make_request('/noop/?jsonp=cb'))")
+
+    # sparse fieldsets: not passed to the method, the result is reduced
+    dispatcher = JsonDispatcher(SampleAPI)
+    assert dispatcher(make_request(
+        '/make_dict/?a=1&b=2&c=3&fields=a,c')).content == '{"a": 1, "c": 3}'
+    assert dispatcher(make_request(
+        '/echo/[{"a":1,"b":2},5]?fields=b')).content == '[{"b": 2}, 5]'
+    # errors are left alone
+    assert 'error' in dispatcher(make_request('/add/?a=1&fields=a')).content
+    dispatcher = JsonDispatcher(SampleAPI, fields_name=None, response_class=False)
+    assert dispatcher(make_request('/make_dict/?fields="a"')) == {'fields': 'a'}
     
     
 
+def test_router():
+    """
+    Test the url router used by the json dispatchers.
+    """
+    router = Router.get(SampleAPI)
+    assert Router.get(SampleAPI) is router
+    assert router.routes['ns/with_param'] is SampleAPI.ns.with_param
+    assert router.routes['rest/resource/get'] is SampleAPI.rest.resource.get
+    assert not 'ns' in router.routes
+
+    dispatcher = JsonDispatcher(SampleAPI, response_class=False)
+    # empty path items are ignored
+    assert dispatcher(make_request('/'), '/ns//with_param/5/') == 5
+    # the last item is an argument or a method name, whatever works
+    assert dispatcher(make_request('/echo/true')) == True
+    raises(BadRequestError, dispatcher, make_request('/echo/{'))
+    raises(MethodNotFoundError, dispatcher, make_request('/echo/foo'))
+    raises(MethodNotFoundError, dispatcher, make_request('/'))
+    try: dispatcher(make_request('/ns/nothing/5'))
+    except MethodNotFoundError, e: assert e.message == 'ns.nothing'
+    try: dispatcher(make_request('/ns/nothing'))
+    except MethodNotFoundError, e: assert e.message == 'ns.nothing'
+    # known urls are matched without looking at the last item
+    dispatcher.ident_regex = None
+    assert dispatcher(make_request('/ns/with_param/5')) == 5
+    assert dispatcher(make_request('/ns/give_me_false')) == False
+
+    # changes to the API are picked up
+    class API(GenericAPI):
+        class Meta: expose_by_default = True
+        def a(request): return True
+    dispatcher = JsonDispatcher(API, response_class=False)
+    router = Router.get(API)
+    API.b = API.a
+    assert dispatcher(make_request('/b')) == True
+    assert Router.get(API) is not router
+    # warming up builds the table ahead of the first request
+    from genericapi.dispatch import _routers
+    API.c = API.a
+    dispatcher.warm()
+    assert sorted(_routers[API].routes) == ['a', 'b', 'c']
+
+def test_stream_dispatch():
+    """
+    Test streaming of generator results.
+    """
+    import time
+    dispatcher = JsonDispatcher(SampleAPI)
+    r = dispatcher(make_request('/count/2'))
+    assert r.content == '0\n1\n'
+    r = dispatcher(make_request('/count/2', accept='text/event-stream'))
+    assert r.content == 'data: 0\n\ndata: 1\n\n'
+    # errors before the stream are sent as usual
+    assert dispatcher(make_request('/count/')).content.startswith('{"error"')
+    # ...as are other iterables
+    assert dispatcher(make_request('/echo/[1,2]')).content == '[1, 2]'
+
+    # errors raised while streaming are formatted like any other
+    class StreamAPI(GenericAPI):
+        class Meta:
+            expose_by_default = True
+            def format_error(request, error): return {'failed': error.message}
+        def fail(request):
+            yield 1
+            raise BadRequestError('gone')
+        @deadline(0.05)
+        def slow(request):
+            time.sleep(0.1)
+            check_deadline()
+            yield True
+    dispatcher = JsonDispatcher(StreamAPI)
+    assert dispatcher(make_request('/fail')).content == \
+                                            '1\n{"failed": "gone"}\n'
+    # heartbeat streams run in another thread, within the deadline as well
+    dispatcher = JsonDispatcher(StreamAPI, stream_heartbeat=0.01)
+    assert dispatcher(make_request('/slow')).content.strip() == \
+                                            '{"failed": ""}'
+
+def test_thread_safety():
+    """
+    Dispatchers keep per-call state in the context only.
+    """
+    import threading
+    dispatcher = JsonDispatcher(SampleAPI)
+    request = make_request('/echo/1?jsonp=cb')
+    assert dispatcher(request).content == 'cb(1)'
+    assert not hasattr(request, '_jsonp_callback')
+
+    # concurrent calls don't get in each other's way
+    results, errors = {}, []
+    def run(i):
+        try:
+            for j in range(50):
+                content = dispatcher(make_request('/echo/%d?jsonp=cb%d' % (j, i))).content
+                if content != 'cb%d(%d)' % (i, j): errors.append(content)
+        except Exception, e:
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert errors == []
+
+    # hooks written for when they were passed the request still work
+    import warnings
+    context = dispatcher.create_context(request)
+    filters = warnings.filters[:]
+    try:
+        warnings.simplefilter('error', DeprecationWarning)
+        raises(DeprecationWarning, getattr, context, 'GET')
+        warnings.simplefilter('ignore', DeprecationWarning)
+        assert context.GET is request.GET
+    finally:
+        warnings.filters[:] = filters
+    raises(AttributeError, getattr, context, 'no_such_attribute')
+
 def test_rest_dispatch():
     """
     Test rest dispatcher.
@@ -146,5 +289,547 @@ def test_rest_dispatch():
     assert dispatcher(make_request('/rest/resource/1', 'PUT', {'v': 1})) == True
     assert dispatcher(make_request('/rest/resource/', 'POST', {'v': 1})) == True
 
+def test_ndjson_payload():
+    """
+    Test streaming of newline-delimited JSON payloads.
+    """
+    from StringIO import StringIO
+    def make_upload(body):
+        r = make_request('/rest/bulk/', 'POST')
+        r.META['CONTENT_TYPE'] = 'application/x-ndjson; charset=utf-8'
+        r._stream, r._read_started = StringIO(body), False
+        return r
+    dispatcher = RestDispatcher(SampleAPI, response_class=False)
+
+    assert dispatcher(make_upload('{"a": 1}\n\n[2]\n3')) == [{'a': 1}, [2], 3]
+    assert dispatcher(make_upload('')) == []
+    raises(BadRequestError, dispatcher, make_upload('1\n{[\n'))
+
+    # records are read one by one, and their size is limited
+    request = make_upload('1\n2\n' + '3' * 20 + '\n')
+    records = iter(NdjsonPayload(request, 20))
+    assert records.next() == 1
+    assert request._stream.tell() == 2
+    assert records.next() == 2
+    assert records.next() == int('3' * 20)
+    raises(BadRequestError, list, NdjsonPayload(make_upload('1' * 21), 20))
+
 def test_xmlrpc_dispatch():
     pass
+
+def test_coalesce():
+    """
+    Test request coalescing for ``@coalesce`` methods.
+    """
+    import threading
+    calls, release = [], threading.Event()
+    class CoalesceAPI(GenericAPI):
+        @expose
+        @coalesce
+        def slow(request, value):
+            calls.append(value)
+            release.wait()
+            return {'value': value}
+        @expose
+        def fast(request): return len(calls)
+
+    dispatcher = JsonDispatcher(CoalesceAPI)
+    results = []
+    def run(url):
+        results.append(dispatcher(make_request(url)))
+    threads = [threading.Thread(target=run, args=('/slow/?value=[1,2]',))
+               for i in range(5)]
+    for thread in threads: thread.start()
+    # wait until all but the first request are waiting for the first one
+    import time
+    while not dispatcher.coalescer.flights or \
+          dispatcher.coalescer.flights.values()[0].waiters < 4:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads: thread.join()
+
+    # the view only ran once, but everybody got a response of their own
+    assert calls == [[1,2]]
+    assert len(results) == 5
+    assert len(set(map(id, results))) == 5
+    assert set([r.content for r in results]) == set(['{"value": [1, 2]}'])
+    # nothing is kept once the call finished
+    assert not dispatcher.coalescer.flights
+    assert dispatcher(make_request('/slow/?value=3')).content == '{"value": 3}'
+    assert calls == [[1,2], 3]
+
+    # different jsonp callbacks are not coalesced
+    r1 = dispatcher.create_context(make_request('/'))
+    r2 = dispatcher.create_context(make_request('/'))
+    r1.jsonp_callback, r2.jsonp_callback = 'a', 'b'
+    assert dispatcher.coalesce_key(r1, CoalesceAPI.slow, [1], {}) != \
+           dispatcher.coalesce_key(r2, CoalesceAPI.slow, [1], {})
+    # unhashable arguments can't be coalesced
+    assert dispatcher.coalesce_key(r1, CoalesceAPI.slow, [object], {'a': {}}) \
+           is not None
+    assert dispatcher.coalesce_key(r1, CoalesceAPI.slow, [set()], {}) is None
+    # equal values of different types are different arguments
+    keys = [dispatcher.coalesce_key(r1, CoalesceAPI.slow, [value], {})
+            for value in (True, 1, 1.0)]
+    assert len(set(keys)) == 3
+
+def test_lazy_arguments():
+    """
+    Test that querystring arguments are only decoded when needed.
+    """
+    class LazyAPI(GenericAPI):
+        class Meta:
+            expose_by_default = True
+            def check_key(request, key): return key == 'abc'
+        def echo(request, value): return value
+        @lazy_arguments('doc')
+        def store(request, doc, flag=False):
+            return [type(doc).__name__, flag, doc.get()]
+    dispatcher = JsonDispatcher(LazyAPI, response_class=False)
+
+    # invalid json in calls that are rejected anyway is never looked at
+    raises(MethodNotFoundError, dispatcher, make_request('/foo/?apikey="abc"&a={['))
+    raises(InvalidKeyError, dispatcher, make_request('/echo/?apikey="x"&value={['))
+    # but of course it is for valid calls
+    raises(BadRequestError, dispatcher, make_request('/echo/?apikey="abc"&value={['))
+    assert dispatcher(make_request('/echo/?apikey="abc"&value=[1]')) == [1]
+
+    # methods can ask for the undecoded value
+    assert dispatcher(make_request('/store/?apikey="abc"&doc={"a": 1}&flag=true')) \
+        == ['LazyArgument', True, {'a': 1}]
+    raises(BadRequestError, dispatcher, make_request('/store/?apikey="abc"&doc={['))
+    # values are only decoded once
+    decoded = []
+    arg = LazyArgument('1', lambda v: decoded.append(v) or int(v))
+    assert arg.get() == 1 and arg.get() == 1
+    assert decoded == ['1']
+
+def test_multi_dispatch():
+    """
+    Test serving multiple formats through one dispatcher.
+    """
+    dispatcher = MultiDispatcher(SampleAPI, {
+        'json': JsonDispatcher(SampleAPI, response_class=False),
+        'rest': RestDispatcher,
+    }, content_types={'application/x-json': 'json'})
+    # state is shared
+    assert dispatcher.dispatchers['json'].coalescer is \
+           dispatcher.dispatchers['rest'].coalescer
+    # but coalesced calls are not shared across formats
+    json, rest = dispatcher.dispatchers['json'], dispatcher.dispatchers['rest']
+    context = json.create_context(make_request('/'))
+    assert json.coalesce_key(context, SampleAPI.echo, [5], {}) != \
+           rest.coalesce_key(context, SampleAPI.echo, [5], {})
+    # warming up covers every format
+    assert sorted(dispatcher.warm()) == sorted(SampleAPI.prepare())
+    assert MultiDispatcher(SampleAPI, {'json': JsonDispatcher}).warm() == \
+           SampleAPI.prepare()
+    raises(ValueError, MultiDispatcher, SampleAPI, {})
+
+    assert dispatcher(make_request('/json/echo/5')) == 5
+    assert dispatcher(make_request('/'), 'json/echo/5') == 5
+    assert dispatcher(make_request('/rest/rest/resource/1', 'GET')).content == 'true'
+    # by content type
+    request = make_request('/echo/5')
+    request.META['CONTENT_TYPE'] = 'application/x-json; charset=utf-8'
+    assert dispatcher(request) == 5
+    # unknown formats
+    raises(BadRequestError, dispatcher, make_request('/xml/echo/5'))
+    dispatcher.default = 'json'
+    assert dispatcher(make_request('/echo/5')) == 5
+
+def test_diagnostics():
+    """
+    Test recording allocations per method.
+    """
+    from genericapi.diagnostics import AllocationTracker
+    dispatcher = JsonDispatcher(SampleAPI)
+    dispatcher.diagnostics = tracker = AllocationTracker()
+    for i in range(3):
+        dispatcher(make_request('/make_list/?1=%d&2=[1,2,3]' % i))
+    dispatcher(make_request('/ns/with_param/"x"'))
+    dispatcher(make_request('/no/such/method'))
+    report = tracker.report(SampleAPI)
+    assert sorted(report) == ['<unresolved>', 'make_list', 'ns.with_param']
+    assert report['make_list']['calls'] == 3
+    assert report['ns.with_param']['calls'] == 1
+    assert report['make_list']['seconds'] > 0
+    tracker.reset()
+    assert tracker.report(SampleAPI) == {}
+
+    # multi dispatchers pass the tracker to their formats
+    multi = MultiDispatcher(SampleAPI, {'json': JsonDispatcher})
+    multi.diagnostics = tracker
+    assert multi.dispatchers['json'].diagnostics is tracker
+    multi(make_request('/json/echo/5'))
+    assert tracker.report(SampleAPI)['echo']['calls'] == 1
+
+    # streams are measured once they have been consumed
+    class StreamAPI(GenericAPI):
+        class Meta: expose_by_default = True
+        def items(request): yield 1
+    dispatcher = JsonDispatcher(StreamAPI)
+    dispatcher.diagnostics = tracker = AllocationTracker()
+    response = dispatcher(make_request('/items'))
+    assert tracker.report(StreamAPI) == {}
+    list(response)
+    assert tracker.report(StreamAPI)['items']['calls'] == 1
+
+def test_query_diagnostics():
+    """
+    Test recording database queries per method.
+    """
+    from genericapi.diagnostics import QueryTracker, CombinedTracker, \
+        AllocationTracker, fingerprint
+    from django.db import connection
+    assert fingerprint("SELECT * FROM a WHERE id = 5 AND name = 'it''s'") == \
+        "SELECT * FROM a WHERE id = ? AND name = ?"
+    assert fingerprint("SELECT * FROM a WHERE id IN (1, 2, 3)") == \
+        "SELECT * FROM a WHERE id IN (...)"
+
+    # what the debug cursor logs
+    class API(GenericAPI):
+        class Meta: expose_by_default = True
+        def items(request, n):
+            assert connection.use_debug_cursor
+            connection.queries.append({'sql': 'SELECT 1', 'time': '0.010'})
+            for i in range(n):
+                connection.queries.append({
+                    'sql': 'SELECT * FROM b WHERE a_id = %d' % i,
+                    'time': '0.001'})
+    dispatcher = JsonDispatcher(API)
+    dispatcher.diagnostics = tracker = QueryTracker()
+    dispatcher(make_request('/items/2'))
+    dispatcher(make_request('/items/4'))
+    report = tracker.report(API)['items']
+    assert report['calls'] == 2
+    assert report['queries'] == 4 and report['max_queries'] == 5
+    assert round(report['query_seconds'], 3) == 0.026
+    assert report['repeated'] == {'SELECT * FROM b WHERE a_id = ?': 4}
+    # the debug cursor is disabled again, and the log not kept
+    assert connection.use_debug_cursor is None
+    assert connection.queries == []
+
+    dispatcher.diagnostics = CombinedTracker(AllocationTracker(), tracker)
+    dispatcher(make_request('/items/0'))
+    report = dispatcher.diagnostics.report(API)['items']
+    assert report['calls'] == 3 and 'objects' in report and 'queries' in report
+
+def test_pagination():
+    """
+    Test keyset pagination.
+    """
+    from genericapi.pagination import encode_cursor, decode_cursor
+
+    # the primary key is added to the ordering, to make it unique
+    assert Page(Item.objects.all()).ordering() == ['-name', 'pk']
+    assert Page(Item.objects.order_by('id')).ordering() == ['id']
+    # rows following the cursor
+    page = Page(Item.objects.all(), encode_cursor(['b', 3]))
+    assert page.values == ['b', 3]
+    assert str(page._after(page.ordering(), page.values)) == \
+        str(models.Q(name__lt=u'b') | (models.Q(name=u'b') & models.Q(pk__gt=3)))
+    raises(BadRequestError, page._after, ['pk'], page.values)
+    raises(BadRequestError, decode_cursor, '!!')
+    raises(BadRequestError, decode_cursor, encode_cursor({'a': 1}))
+    # projections are left to the serializer
+    page = JsonResponse(Page(Item.objects.all()), fields=('name',)).data
+    assert page.queryset.query.deferred_loading == (set(), True)
+
+    # the cursor argument is never passed to the method; other results
+    # are returned unchanged
+    dispatcher = JsonDispatcher(SampleAPI, response_class=False)
+    assert dispatcher(make_request('/pages/?cursor="abc"')) == [0, 1, 2]
+    assert dispatcher(make_request('/pages/?n=1')) == [0]
+
+    # walking through all pages returns every row once, in order, even
+    # with rows that share the value of the ordering field
+    from django.utils import simplejson
+    for name in 'bacbdb':
+        Item.objects.create(name=name)
+    try:
+        dispatcher = JsonDispatcher(SampleAPI)
+        url, rows, pages = '/item_pages/', [], []
+        while url:
+            page = simplejson.loads(dispatcher(make_request(url)).content)
+            assert sorted(page) == ['next', 'results']
+            pages.append(len(page['results']))
+            rows.extend([(r['fields']['name'], r['pk'])
+                         for r in page['results']])
+            url = page['next'] and '/item_pages/?cursor="%s"' % page['next']
+        assert pages == [2, 2, 2]
+        assert rows == sorted([(item.name, item.pk) for item in
+                               Item.objects.all()],
+                              key=lambda (name, pk): (-ord(name), pk))
+        assert [name for name, pk in rows] == list('dcbbba')
+        # the cursor of the last row goes past the end
+        last = Item.objects.get(name='a')
+        assert dispatcher(make_request('/item_pages/?cursor="%s"' %
+            encode_cursor(['a', last.pk]))).content == \
+            '{"results": [], "next": null}'
+    finally:
+        Item.objects.all().delete()
+
+def test_queryset_fields():
+    """
+    Test sparse fieldsets of querysets.
+    """
+    from django.utils import simplejson
+    Item.objects.create(name='a')
+    try:
+        dispatcher = JsonDispatcher(SampleAPI)
+        def get(url):
+            return simplejson.loads(dispatcher(make_request(url)).content)
+        # the objects are still labeled with the model, not a deferred class
+        assert get('/items/?fields=name') == \
+            [{'pk': 1, 'model': 'tests.item', 'fields': {'name': 'a'}}]
+        assert get('/items/?fields=foo') == \
+            [{'pk': 1, 'model': 'tests.item', 'fields': {}}]
+        assert get('/items/') == get('/items/?fields=name')
+    finally:
+        Item.objects.all().delete()
+
+def test_deadlines():
+    """
+    Test time budgets of calls.
+    """
+    import time, threading
+    class API(GenericAPI):
+        class Meta:
+            expose_by_default = True
+            timeout = 10
+        def budget(request): return round(remaining_time())
+        @deadline(None)
+        def inherited(request): return remaining_time()
+        @deadline(False)
+        def unlimited(request): return remaining_time()
+        @deadline(0.05)
+        def slow(request):
+            time.sleep(0.1)
+            check_deadline()
+        @deadline(0)
+        def expired(request): return True
+        def nested(request):
+            return API.get_client().budget(request=None)
+        @deadline(0.05)
+        @coalesce
+        def shared(request):
+            started.set(); release.wait()
+            return True
+    started, release = threading.Event(), threading.Event()
+
+    dispatcher = JsonDispatcher(API, response_class=False)
+    assert dispatcher(make_request('/budget')) == 10
+    assert round(dispatcher(make_request('/inherited'))) == 10
+    assert dispatcher(make_request('/unlimited')) is None
+    # the client can ask for a shorter, but not a longer budget
+    request = make_request('/budget')
+    request.META['HTTP_X_TIMEOUT'] = '5'
+    assert dispatcher(request) == 5
+    request.META['HTTP_X_TIMEOUT'] = '20'
+    assert dispatcher(request) == 10
+    request.META['HTTP_X_TIMEOUT'] = 'soon'
+    raises(BadRequestError, dispatcher, request)
+    # calls made from within a call inherit it's deadline
+    request = make_request('/nested')
+    request.META['HTTP_X_TIMEOUT'] = '5'
+    assert dispatcher(request) == 5
+    # calls running out of time
+    raises(DeadlineExceededError, dispatcher, make_request('/slow'))
+    raises(DeadlineExceededError, dispatcher, make_request('/expired'))
+    assert remaining_time() is None
+    assert JsonDispatcher(API)(make_request('/expired')).status_code == 504
+
+    # waiting for a coalesced call gives up at the deadline
+    results = []
+    leader = threading.Thread(target=lambda:
+        results.append(dispatcher(make_request('/shared'))))
+    leader.start()
+    started.wait()
+    raises(DeadlineExceededError, dispatcher, make_request('/shared'))
+    release.set()
+    leader.join()
+    assert results == [True]
+
+    # streams run within the deadline while they are consumed
+    class StreamAPI(GenericAPI):
+        class Meta: expose_by_default = True
+        @deadline(0.05)
+        def items(request):
+            yield remaining_time() is not None
+            time.sleep(0.1)
+            check_deadline()
+            yield True
+    dispatcher = JsonDispatcher(StreamAPI)
+    response = dispatcher(make_request('/items'))
+    assert remaining_time() is None
+    assert list(response) == ['true\n', '{"error": "Deadline Exceeded"}\n']
+
+def test_concurrency_limits():
+    """
+    Test limiting the calls in progress per method and namespace.
+    """
+    import threading, time
+    from genericapi.limits import Bulkhead
+    bulkhead = Bulkhead(1, queue=1)
+    assert bulkhead.acquire()
+    assert not bulkhead.acquire(0.01)   # waited in the queue, and gave up
+    bulkhead.waiting = 1                # queue full: no waiting at all
+    assert not bulkhead.acquire()
+    bulkhead.waiting = 0
+    bulkhead.release()
+    assert bulkhead.acquire(0) and bulkhead.active == 1
+
+    started, release = threading.Semaphore(0), threading.Event()
+    class API(GenericAPI):
+        class Meta: expose_by_default = True
+        def cheap(request): return True
+        @max_concurrency(1)
+        def single(request):
+            started.release(); release.wait()
+            return True
+        class reports(Namespace):
+            class Meta:
+                max_concurrency = 2
+                max_queue = 1
+            def run(request):
+                started.release(); release.wait()
+                return True
+            class sub(Namespace):
+                def run(request):
+                    started.release(); release.wait()
+                    return True
+
+    dispatcher = JsonDispatcher(API, response_class=False)
+    results = []
+    def call(url):
+        thread = threading.Thread(
+            target=lambda: results.append(dispatcher(make_request(url))))
+        thread.start()
+        return thread
+    # the namespace limit is shared with it's sub-namespaces
+    threads = [call('/reports/run'), call('/reports/sub/run'), call('/single')]
+    for i in range(3): started.acquire()
+    raises(OverloadedError, dispatcher, make_request('/single'))
+    # one call may wait; it gives up at it's deadline
+    request = make_request('/reports/run')
+    request.META['HTTP_X_TIMEOUT'] = '0.01'
+    raises(DeadlineExceededError, dispatcher, request)
+    threads.append(call('/reports/sub/run'))
+    namespace_bulkhead = API.reports.run.get_plan().bulkheads[0]
+    while namespace_bulkhead.waiting == 0:
+        time.sleep(0.001)
+    raises(OverloadedError, dispatcher, make_request('/reports/run'))
+    assert JsonDispatcher(API)(make_request('/reports/run')).status_code == 503
+    # other methods are not affected
+    assert dispatcher(make_request('/cheap')) == True
+    release.set()
+    for thread in threads: thread.join()
+    assert results == [True] * 4
+
+    # streams hold on to the limits until they have been consumed or closed
+    class StreamAPI(GenericAPI):
+        class Meta: expose_by_default = True
+        @max_concurrency(1)
+        def items(request):
+            yield 1; yield 2
+    dispatcher = JsonDispatcher(StreamAPI)
+    response = dispatcher(make_request('/items'))
+    assert dispatcher(make_request('/items')).status_code == 503
+    assert list(response) == ['1\n', '2\n']
+    response = dispatcher(make_request('/items'))
+    assert dispatcher(make_request('/items')).status_code == 503
+    response.close()
+    response = dispatcher(make_request('/items'))
+    del response
+    assert StreamAPI.items.get_plan().bulkheads[0].active == 0
+
+def test_background_jobs():
+    """
+    Test running calls in the background.
+    """
+    import threading, time
+    from django.utils import simplejson
+    release = threading.Event()
+    class Inline(object):
+        def submit(self, func): func()
+    class API(GenericAPI):
+        class Meta:
+            expose_by_default = True
+            def check_key(request, key): return key == 'k'
+        @background
+        def report(request, n):
+            release.wait()
+            return {'n': n}
+        class inline(Namespace):
+            class Meta: job_executor = Inline()
+            @background
+            def fail(request): raise BadRequestError('no')
+            @background
+            def get(request, id): return id
+    class Plain(GenericAPI):
+        def echo(request): pass
+    # the namespace to poll jobs is only added where needed
+    assert API.resolve(['jobs', 'get']) and API.resolve(['jobs', 'status'])
+    assert not hasattr(Plain, 'jobs')
+
+    dispatcher = JsonDispatcher(API)
+    response = dispatcher(make_request('/report/?n=3&apikey="k"'))
+    assert response.status_code == 202
+    job_id = simplejson.loads(response.content)['id']
+    assert response['Location'] == '/jobs/get/%22' + job_id + '%22'
+    # polling requires the key as well
+    status = dispatcher(make_request('/jobs/status/"%s"?apikey="k"' % job_id))
+    assert status.content in ('"pending"', '"running"')
+    assert 'Invalid' in dispatcher(
+        make_request('/jobs/status/"%s"' % job_id)).content
+    assert dispatcher(make_request(
+        '/jobs/get/"%s"?apikey="k"' % job_id)).status_code == 202
+    release.set()
+    for i in range(1000):
+        response = dispatcher(make_request('/jobs/get/"%s"?apikey="k"' % job_id))
+        if response.status_code != 202: break
+        time.sleep(0.001)
+    assert response.content == '{"n": 3}'
+    raises(BadRequestError, API.execute, 'jobs.get', 'unknown', apikey='k')
+
+    # custom executors, failing jobs
+    response = API.execute('inline.fail', apikey='k',
+                           response_class=JsonResponse)
+    job_id = simplejson.loads(response.content)['id']
+    assert API.execute('jobs.status', job_id, apikey='k') == 'failed'
+    raises(BadRequestError, API.execute, 'jobs.get', job_id, apikey='k')
+    # rest urls
+    request = make_request('/api/inline/"x"', method='GET')
+    request.GET = QueryDict('apikey="k"')
+    response = RestDispatcher(API)(request, 'inline/"x"')
+    assert response['Location'].startswith('/api/jobs/%22')
+
+    # the store is bounded, and doesn't hand out expired jobs
+    from genericapi.jobs import JobStore, Job
+    store = JobStore(keep=60, max_jobs=2)
+    first, second, third = Job(API), Job(API), Job(API)
+    store.add(first); store.add(second)
+    raises(OverloadedError, store.add, third)
+    first.finished = time.time() - 10
+    second.finished = time.time()
+    store.add(third)
+    assert store.get(first.id) is None and store.get(second.id) is second
+    second.finished = time.time() - 61
+    assert store.get(second.id) is None
+    store.next_purge = 0
+    store.get(third.id)
+    assert store.jobs.keys() == [third.id]
+
+    # background methods in namespaces loaded later can be polled as well
+    class LazyAPI(GenericAPI):
+        class Meta: expose_by_default = True
+        exports = LazyNamespace('tests.lazy_reports.ExportsNamespace')
+    assert not hasattr(LazyAPI, 'jobs')
+    dispatcher = JsonDispatcher(LazyAPI, response_class=False)
+    job_id = dispatcher(make_request('/exports/build'))['id']
+    for i in range(1000):
+        if dispatcher(make_request('/jobs/status/"%s"' % job_id)) == 'done':
+            break
+        time.sleep(0.001)
+    assert dispatcher(make_request('/jobs/get/"%s"' % job_id)) == 'done'
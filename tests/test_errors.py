@@ -54,4 +54,15 @@ def test_custom_formatting():
         assert e.data['num'] == 99
         # hook can modified the error instance directly
         assert e.http_status == 555
-        assert e.custom_arg == True
\ No newline at end of file
+        assert e.custom_arg == True
+    # the hook is applied to messageless errors as well, even though those are
+    # usually formatted from a cache.
+    class PlainAPI(GenericAPI):
+        class Meta:
+            expose_by_default = True
+            def format_error(request, error):
+                return {'plain': error.name}
+        def fail(request): raise BadRequestError()
+    for i in range(2):
+        r = PlainAPI.execute('fail', response_class=JsonResponse)
+        assert r.content == '{"plain": "Bad Request"}'
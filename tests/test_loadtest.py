@@ -0,0 +1,22 @@
+"""
+Test the load generation harness.
+"""
+
+from shared import *
+from genericapi import loadtest
+
+def test_run():
+    results = loadtest.run(threads=2, requests=20)
+    assert sorted(results) == ['execute', 'json', 'rest']
+    for result in results.values():
+        assert result['requests'] == 40
+        assert sum(result['status'].values()) == 40
+        assert result['latency'][50] <= result['latency'][100]
+    assert results['rest']['status'] == {200: 40}
+    # the json mix includes rejected calls
+    assert 200 in results['json']['status']
+
+    # the same seed always produces the same calls
+    import random
+    calls = lambda: [c for c, i in zip(loadtest._json_calls(random.Random(1)), range(50))]
+    assert calls() == calls()
@@ -19,6 +19,8 @@ def test_common():
     APIResponse('')
     APIResponse({'count': 1})
     APIResponse({'count': 1}, http_status=200, http_headers={'custom': True})
+    # responses don't need a ``__dict__``
+    assert not hasattr(JsonResponse(''), '__dict__')
     
     # If passed an exception, it's values are used
     e = APIError('message', code=9,
@@ -93,4 +95,81 @@ def test_json_response():
     # an empty callback string is allowed too, and will still cause a
     # parenthesis  wrap
     assert JsonResponse([1, True], jsonp_callback='').\
-        get_response().content == '([1, true])'
\ No newline at end of file
+        get_response().content == '([1, true])'
+    # the jsonp wrapper is passed along as separate chunks, and not joined
+    # with the body.
+    r = JsonResponse({'a': 1}, jsonp_callback=u'call').get_response()
+    assert list(r) == ['call(', '{"a": 1}', ')']
+    assert [type(chunk) for chunk in r] == [str, str, str]
+    # errors go the same way
+    r = JsonResponse(APIError('fail'), jsonp_callback='call').get_response()
+    assert len(list(r)) == 3
+    # without jsonp, the body is a plain string
+    assert not JsonResponse({'a': 1}).get_response()._base_content_is_iter
+
+    # messageless errors are only serialized once per class
+    from genericapi.response import _error_bodies
+    _error_bodies.clear()
+    assert format(InvalidKeyError()) == '{"error": "Invalid API Key"}'
+    assert format(InvalidKeyError()) == '{"error": "Invalid API Key"}'
+    assert _error_bodies.values() == ['{"error": "Invalid API Key"}']
+    # errors with a message reuse the body around it
+    assert format(InvalidKeyError('foo')) == '{"error": "Invalid API Key: foo"}'
+    assert len(_error_bodies) == 2
+    from django.utils import simplejson
+    for message in ('a "b"', u'\xe4\n', 'x' * 100):
+        error = MethodNotFoundError(message)
+        assert format(error) == simplejson.dumps(error.data)
+    assert format(MethodNotFoundError(method=['a', 'b'])) == \
+                                '{"error": "Method Not Found: a.b"}'
+    # but everything else is formatted individually
+    assert format(InvalidKeyError(code=2)) == \
+                                '{"code": 2, "error": "Invalid API Key"}'
+    e = InvalidKeyError(); e.data = {'custom': True}
+    assert format(e) == '{"custom": true}'
+    assert len(_error_bodies) == 3
+
+    # projection to a sparse fieldset
+    def project(data, fields):
+        return JsonResponse(data, fields=fields).data
+    assert project({'a': 1, 'b': 2}, ('a', 'c')) == {'a': 1}
+    assert project([{'a': 1, 'b': 2}, 'x'], ('b',)) == [{'b': 2}, 'x']
+    assert project([{'a': 1}], ('c',)) == [{}]
+    assert project(5, ('a',)) == 5
+    assert project(APIResponse({'a': 1}, http_status=201), ('b',)) == {}
+
+def test_stream_response():
+    """
+    Test streaming responses.
+    """
+    def items():
+        yield 1
+        yield {'a': 'b\nc'}
+        raise APIError('stop')
+    r = StreamResponse(items()).get_response()
+    assert r['Content-Type'] == 'application/x-ndjson'
+    assert list(r) == ['1\n', '{"a": "b\\nc"}\n', '{"error": "API Error: stop"}\n']
+
+    r = StreamResponse(items(), stream_format='sse').get_response()
+    assert r['Content-Type'] == 'text/event-stream'
+    assert list(r) == ['data: 1\n\n', 'data: {"a": "b\\nc"}\n\n',
+                       'event: error\ndata: {"error": "API Error: stop"}\n\n']
+
+    # heartbeats are sent while waiting for the next item
+    import threading
+    release = threading.Event()
+    def slow():
+        yield 1
+        release.wait()
+        yield 2
+    r = iter(StreamResponse(slow(), heartbeat=0.01).get_response())
+    assert r.next() == '1\n'
+    assert r.next() == '\n'
+    release.set()
+    assert '2\n' in list(r)
+
+    # other exceptions are raised, even from the producer thread
+    def broken():
+        yield 1
+        raise TypeError()
+    raises(TypeError, list, StreamResponse(broken(), heartbeat=1).get_response())